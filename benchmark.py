@@ -0,0 +1,193 @@
+import argparse
+import clusters
+import distances
+import json
+import numpy as np
+import os
+from PIL import ImageFont
+import platform
+import random
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+# synthetic word counts shaped like blogdata.tsv; sparsity is the fraction
+# of cells that are zero
+def make_blog_matrix(rows=100, cols=500, sparsity=0.9, seed=0):
+    rng = np.random.default_rng(seed)
+    # a handful of topics so there is some structure to cluster
+    topics = rng.gamma(1.0, 2.0, (max(1, rows // 20), cols))
+    data = rng.poisson(topics[rng.integers(len(topics), size=rows)])
+    data[rng.random((rows, cols)) < sparsity] = 0
+    col_names = ['word%d' % i for i in range(cols)]
+    row_names = ['blog%d' % i for i in range(rows)]
+    return col_names, row_names, data.astype(float)
+
+# counts single distance evaluations for plain callables
+class CountingDistance:
+    def __init__(self, distance):
+        self.distance = distance
+        self.calls = 0
+
+    def __call__(self, v1, v2):
+        self.calls += 1
+        return self.distance(v1, v2)
+
+# counts the pairs a batched kernel compares
+class CountingKernel(distances.Kernel):
+    def __init__(self, kernel):
+        self.kernel = kernel
+        self.row_type = kernel.row_type
+        self.calls = 0
+
+    def compare(self, a, b):
+        self.calls += len(a) * len(b)
+        return self.kernel.compare(a, b)
+
+    def compare_paired(self, a, b):
+        self.calls += len(a)
+        return self.kernel.compare_paired(a, b)
+
+def measure(name, function, counter, **settings):
+    tracemalloc.start()
+    start = time.perf_counter()
+    function()
+    wall_time = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    result = {'name': name, 'wall_time': wall_time, 'peak_memory': peak,
+            'distance_calls': counter.calls}
+    result.update(settings)
+    return result
+
+# (name, counter, function) triples; each function takes its counter as
+# the distance so the calls it makes are counted. out_dir holds the
+# images drawn
+def get_benchmarks(data, labels, iterations, slow_limit, out_dir,
+        names=None):
+    font = ImageFont.load_default()
+    rows = data.tolist()
+    pearson = lambda: CountingKernel(distances.Pearson())
+    benchmarks = []
+    if len(rows) <= slow_limit:
+        benchmarks.append(('hcluster', CountingDistance(clusters.pearson),
+            lambda d: clusters.hcluster(rows, d)))
+    for linkage in ('average', 'single'):
+        benchmarks.append(('hcluster_' + linkage, pearson(),
+            lambda d, linkage=linkage: clusters.hcluster(data, d,
+                linkage=linkage, compact=True)))
+    benchmarks.append(('kcluster', pearson(),
+        lambda d: clusters.kcluster(rows, 4, d)))
+    benchmarks.append(('kcluster_kmeans++', pearson(),
+        lambda d: clusters.kcluster(rows, 4, d, init='k-means++')))
+    benchmarks.append(('scale_down', pearson(),
+        lambda d: clusters.scale_down(rows, d, max_iterations=iterations)))
+    benchmarks.append(('scale_down_smacof', pearson(),
+        lambda d: clusters.scale_down(rows, d, method='smacof',
+            max_iterations=iterations)))
+
+    if not names or 'draw_dendrogram' in names:
+        tree = clusters.hcluster(data, linkage='average')
+        out = os.path.join(out_dir, 'dendrogram.jpg')
+        benchmarks.append(('draw_dendrogram',
+            CountingDistance(clusters.pearson),
+            lambda d: clusters.draw_dendrogram(tree, labels, font, out)))
+    return benchmarks
+
+def run_benchmarks(sizes, cols=500, sparsity=0.9, iterations=50,
+        slow_limit=200, seed=0, names=None):
+    results = []
+    with tempfile.TemporaryDirectory() as out_dir:
+        for rows in sizes:
+            col_names, row_names, data = make_blog_matrix(rows, cols,
+                    sparsity, seed)
+            for name, counter, function in get_benchmarks(data, row_names,
+                    iterations, slow_limit, out_dir, names):
+                if names and name not in names:
+                    continue
+                random.seed(seed)
+                results.append(measure(name, lambda: function(counter),
+                    counter, rows=rows, cols=cols, sparsity=sparsity))
+                print('%-20s rows=%-6d %8.3fs %10.1fMB %12d calls' % (name,
+                    rows, results[-1]['wall_time'],
+                    results[-1]['peak_memory'] / 2 ** 20,
+                    results[-1]['distance_calls']))
+    return results
+
+# compares the merges of the linkage engine with scipy's on random rows;
+# returns the (linkage, trial) pairs that differ. scipy is only needed here
+def check_linkages(rows=40, cols=5, trials=50, seed=0):
+    from scipy.cluster.hierarchy import linkage as scipy_linkage
+    rng = np.random.default_rng(seed)
+    failures = []
+    for trial in range(trials):
+        data = rng.random((rows, cols))
+        for linkage in ('single', 'complete', 'average', 'centroid'):
+            merges = clusters.hcluster(data, clusters.euclidean, linkage,
+                    compact=True).merges
+            expected = scipy_linkage(data, linkage)
+            if not np.array_equal(merges[:, [0, 1, 3]],
+                    expected[:, [0, 1, 3]]) or \
+                    not np.allclose(merges[:, 2], expected[:, 2]):
+                failures.append((linkage, trial))
+    return failures
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def save_results(results, filename):
+    with open(filename, 'w') as out:
+        json.dump({'commit': get_commit(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'results': results}, out, indent=2)
+
+# prints the wall time and memory ratios of new over old for every run
+# present in both files
+def compare_results(old_file, new_file):
+    with open(old_file, 'r') as fin:
+        old = json.load(fin)
+    with open(new_file, 'r') as fin:
+        new = json.load(fin)
+    key = lambda r: (r['name'], r['rows'], r['cols'], r['sparsity'])
+    baseline = dict((key(r), r) for r in old['results'])
+    print('%s -> %s' % (old.get('commit'), new.get('commit')))
+    for result in new['results']:
+        if key(result) not in baseline:
+            continue
+        before = baseline[key(result)]
+        print('%-20s rows=%-6d time x%.2f memory x%.2f' % (result['name'],
+            result['rows'],
+            result['wall_time'] / max(before['wall_time'], 1e-9),
+            result['peak_memory'] / max(before['peak_memory'], 1)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[100, 400])
+    parser.add_argument('--cols', type=int, default=500)
+    parser.add_argument('--sparsity', type=float, default=0.9)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--slow-limit', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', nargs='*')
+    parser.add_argument('--out', default='benchmark.json')
+    parser.add_argument('--compare')
+    parser.add_argument('--check', action='store_true')
+    args = parser.parse_args()
+
+    if args.check:
+        failures = check_linkages(seed=args.seed)
+        print('%d linkages differ from scipy' % len(failures))
+        for linkage, trial in failures:
+            print('%s trial %d' % (linkage, trial))
+        raise SystemExit(1 if failures else 0)
+
+    results = run_benchmarks(args.rows, args.cols, args.sparsity,
+            args.iterations, args.slow_limit, args.seed, args.only)
+    save_results(results, args.out)
+    if args.compare:
+        compare_results(args.compare, args.out)
@@ -0,0 +1,173 @@
+import csv
+import json
+import numpy as np
+import struct
+
+# fixed header: magic, version, layout, rows, columns, non-zeros and the
+# offset and length of the JSON row and column names, which go at the end
+# so rows can be streamed in before all names are known
+MAGIC = b'BLOGMAT\0'
+VERSION = 1
+HEADER = struct.Struct('<8sIIQQQQQ')
+HEADER_SIZE = 64
+ALIGNMENT = 64
+DENSE = 0
+CSR = 1
+LAYOUTS = {'dense': DENSE, 'csr': CSR}
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def is_matrix_file(filename):
+    with open(filename, 'rb') as fin:
+        return MAGIC == fin.read(len(MAGIC))
+
+class MatrixWriter:
+    def __init__(self, dst, col_names, layout='dense'):
+        self.out = open(dst, 'wb')
+        self.col_names = list(col_names)
+        self.row_names = []
+        self.layout = LAYOUTS[layout]
+        # csr rows are kept in memory, dense rows go straight to disk
+        self.indptr = [0]
+        self.indices = []
+        self.values = []
+        self.out.write(b'\0' * HEADER_SIZE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write_row(self, name, values):
+        values = np.asarray(values, dtype=np.float32)
+        self.row_names.append(name)
+        if DENSE == self.layout:
+            self.out.write(values.tobytes())
+            return
+        nonzero = np.flatnonzero(values)
+        self.indices.extend(nonzero.tolist())
+        self.values.extend(values[nonzero].tolist())
+        self.indptr.append(len(self.indices))
+
+    def write_block(self, array, dtype):
+        self.out.write(b'\0' * (align(self.out.tell()) - self.out.tell()))
+        self.out.write(np.asarray(array, dtype=dtype).tobytes())
+
+    def close(self):
+        if self.out.closed:
+            return
+        if CSR == self.layout:
+            self.write_block(self.indptr, np.int64)
+            self.write_block(self.indices, np.int32)
+            self.write_block(self.values, np.float32)
+        names = json.dumps({'rows': self.row_names,
+            'columns': self.col_names}).encode('utf-8')
+        names_offset = align(self.out.tell())
+        self.out.write(b'\0' * (names_offset - self.out.tell()))
+        self.out.write(names)
+        self.out.seek(0)
+        self.out.write(HEADER.pack(MAGIC, VERSION, self.layout,
+            len(self.row_names), len(self.col_names), len(self.indices),
+            names_offset, len(names)))
+        self.out.close()
+
+# a column-major view of row-major data that builds columns on access
+class ColumnView:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows[0]) if len(self.rows) else 0
+
+    def __getitem__(self, i):
+        return [row[i] for row in self.rows]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+class BlogMatrix:
+    def __init__(self, filename):
+        with open(filename, 'rb') as fin:
+            (magic, version, layout, rows, cols, nnz, names_offset,
+                    names_length) = HEADER.unpack(fin.read(HEADER.size))
+            if MAGIC != magic:
+                raise ValueError(filename + ' is not a blog matrix')
+            if VERSION < version:
+                raise ValueError('unsupported blog matrix version ' +
+                        str(version))
+            fin.seek(names_offset)
+            names = json.loads(fin.read(names_length).decode('utf-8'))
+        self.row_names = names['rows']
+        self.col_names = names['columns']
+        self.layout = layout
+        self.shape = (rows, cols)
+        self.dense = None
+        if DENSE == layout:
+            if 0 == rows * cols:
+                self.dense = np.empty(self.shape, dtype=np.float32)
+                return
+            self.dense = np.memmap(filename, dtype=np.float32, mode='r',
+                    offset=HEADER_SIZE, shape=self.shape)
+            return
+        offset = HEADER_SIZE
+        self.indptr = np.memmap(filename, dtype=np.int64, mode='r',
+                offset=offset, shape=(rows + 1,))
+        offset = align(offset + self.indptr.nbytes)
+        self.indices = np.memmap(filename, dtype=np.int32, mode='r',
+                offset=offset, shape=(nnz,)) if nnz else np.empty(0, np.int32)
+        offset = align(offset + 4 * nnz)
+        self.values = np.memmap(filename, dtype=np.float32, mode='r',
+                offset=offset, shape=(nnz,)) if nnz else \
+                        np.empty(0, np.float32)
+
+    def row(self, i):
+        if self.dense is not None:
+            return self.dense[i]
+        result = np.zeros(self.shape[1], dtype=np.float32)
+        start, end = self.indptr[i], self.indptr[i + 1]
+        result[self.indices[start:end]] = self.values[start:end]
+        return result
+
+    # zero-copy for the dense layout; csr is expanded into memory
+    def to_dense(self):
+        if self.dense is not None:
+            return self.dense
+        result = np.zeros(self.shape, dtype=np.float32)
+        rows = np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+        result[rows, self.indices] = self.values
+        return result
+
+    def columns(self):
+        if self.dense is not None:
+            return self.dense.T
+        return ColumnView(self)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, i):
+        return self.row(i)
+
+def open_matrix(filename):
+    return BlogMatrix(filename)
+
+def tsv_to_matrix(src, dst, layout='dense'):
+    with open(src, 'r') as fin:
+        reader = csv.reader(fin, delimiter='\t')
+        col_names = next(reader)[1:]
+        with MatrixWriter(dst, col_names, layout) as writer:
+            for row in reader:
+                if row:
+                    writer.write_row(row[0], [float(x) for x in row[1:]])
+
+def matrix_to_tsv(src, dst):
+    matrix = open_matrix(src)
+    with open(dst, 'w') as out:
+        writer = csv.writer(out, delimiter='\t')
+        writer.writerow(['blog'] + matrix.col_names)
+        for i in range(len(matrix)):
+            writer.writerow([matrix.row_names[i]] +
+                    ['%.9g' % x for x in matrix.row(i)])
@@ -0,0 +1,183 @@
+import clusters
+import distances
+import numpy as np
+
+# distances a saved model can refer to by name
+DISTANCES = {
+        'pearson': clusters.pearson,
+        'euclidean': clusters.euclidean,
+        'tanimoto': distances.Tanimoto()}
+
+DRIFT_THRESHOLD = 0.25
+
+def get_distance(name):
+    if name not in DISTANCES:
+        raise ValueError('unknown distance ' + str(name))
+    return DISTANCES[name]
+
+# distance of every row to its nearest centroid, and that centroid
+def get_nearest(rows, centroids, distance):
+    result = clusters.get_centroid_distances(rows, centroids, distance,
+            clusters.get_kernel(distance))
+    nearest = result.argmin(axis=1)
+    return nearest, result[np.arange(len(result)), nearest]
+
+# tracks how far new rows land from their centroids compared with the rows
+# the model was built from; drift is the relative increase
+class Drift:
+    def __init__(self, baseline, total=0.0, count=0):
+        self.baseline = baseline
+        self.total = total
+        self.count = count
+
+    def add(self, row_distances):
+        self.total += float(np.sum(row_distances))
+        self.count += len(row_distances)
+
+    def value(self):
+        if 0 == self.count or 0 == self.baseline:
+            return 0.0
+        return self.total / self.count / self.baseline - 1.0
+
+class KMeansModel:
+    def __init__(self, centroids, counts, distance='pearson', baseline=0.0):
+        self.centroids = np.asarray(centroids, dtype=float)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.distance = distance
+        self.drift = Drift(baseline)
+
+    @classmethod
+    def fit(cls, rows, k=4, distance='pearson', **kwargs):
+        data = np.asarray(rows, dtype=float)
+        matches, final = clusters.kcluster(data, k=k,
+                distance=get_distance(distance), return_centroids=True,
+                **kwargs)
+        # a zero centroid would be nearest to everything under pearson, so
+        # empty clusters keep the centroid k-means left them at
+        centroids = np.array([data[match].mean(axis=0) if match else
+            final[i] for i, match in enumerate(matches)])
+        counts = [len(match) for match in matches]
+        model = cls(centroids, counts, distance)
+        _, row_distances = get_nearest(data, centroids,
+                get_distance(distance))
+        model.drift.baseline = float(row_distances.mean())
+        return model
+
+    def assign(self, rows):
+        return get_nearest(rows, self.centroids,
+                get_distance(self.distance))[0]
+
+    # moves the centroids by the new rows only; returns their clusters
+    def partial_fit(self, rows):
+        data = np.asarray(rows, dtype=float)
+        nearest, row_distances = get_nearest(data, self.centroids,
+                get_distance(self.distance))
+        self.centroids, self.counts = clusters.absorb_rows(self.centroids,
+                self.counts, data, nearest)
+        self.drift.add(row_distances)
+        return nearest
+
+    def needs_rebuild(self, threshold=DRIFT_THRESHOLD):
+        return threshold < self.drift.value()
+
+    def save(self, filename):
+        with open(filename, 'wb') as out:
+            np.savez(out, centroids=self.centroids, counts=self.counts,
+                    distance=np.array(self.distance),
+                    drift=np.array([self.drift.baseline, self.drift.total,
+                        self.drift.count]))
+
+def load_kmeans_model(filename):
+    with np.load(filename) as data:
+        model = KMeansModel(data['centroids'], data['counts'],
+                str(data['distance']))
+        baseline, total, count = data['drift'].tolist()
+        model.drift = Drift(baseline, total, int(count))
+    return model
+
+# the linkage tree is kept as built; new rows are attached to the nearest
+# of the summary clusters the tree is cut into, whose centroids move online
+class HierarchicalModel:
+    def __init__(self, merges, summaries, centroids, counts,
+            distance='pearson', baseline=0.0):
+        self.merges = np.asarray(merges, dtype=float)
+        self.n = len(self.merges) + 1
+        self.summaries = np.asarray(summaries, dtype=np.int64)
+        self.centroids = np.asarray(centroids, dtype=float)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.distance = distance
+        self.drift = Drift(baseline)
+        # cluster of every row inserted since the tree was built
+        self.inserted = []
+
+    @classmethod
+    def fit(cls, rows, linkage='average', distance='pearson',
+            summary_clusters=32, workers=None):
+        data = np.asarray(rows, dtype=float)
+        tree = clusters.hcluster(data, get_distance(distance), linkage,
+                compact=True, workers=workers)
+        summaries = cut_tree(tree.merges, len(data), summary_clusters)
+        members = [tree.members(node) for node in summaries]
+        centroids = np.array([data[member].mean(axis=0)
+            for member in members])
+        counts = [len(member) for member in members]
+        model = cls(tree.merges, summaries, centroids, counts, distance)
+        assigned = np.empty(len(data), dtype=np.int64)
+        for i, member in enumerate(members):
+            assigned[member] = i
+        row_distances = clusters.get_centroid_distances(data, centroids,
+                get_distance(distance),
+                clusters.get_kernel(get_distance(distance)))
+        model.drift.baseline = float(
+                row_distances[np.arange(len(data)), assigned].mean())
+        return model
+
+    def tree(self, rows):
+        return clusters.LinkageTree(self.merges, rows)
+
+    # rows are numbered after the ones the tree was built from
+    def insert(self, rows):
+        data = np.asarray(rows, dtype=float)
+        nearest, row_distances = get_nearest(data, self.centroids,
+                get_distance(self.distance))
+        self.centroids, self.counts = clusters.absorb_rows(self.centroids,
+                self.counts, data, nearest)
+        self.drift.add(row_distances)
+        self.inserted.extend(nearest.tolist())
+        return nearest
+
+    def members(self, summary):
+        result = clusters.LinkageTree(self.merges, range(self.n)).members(
+                int(self.summaries[summary]))
+        result.extend(self.n + i for i, cluster in enumerate(self.inserted)
+                if cluster == summary)
+        return result
+
+    def needs_rebuild(self, threshold=DRIFT_THRESHOLD):
+        return threshold < self.drift.value()
+
+    def save(self, filename):
+        with open(filename, 'wb') as out:
+            np.savez(out, merges=self.merges, summaries=self.summaries,
+                    centroids=self.centroids, counts=self.counts,
+                    inserted=np.array(self.inserted, dtype=np.int64),
+                    distance=np.array(self.distance),
+                    drift=np.array([self.drift.baseline, self.drift.total,
+                        self.drift.count]))
+
+def load_hierarchical_model(filename):
+    with np.load(filename) as data:
+        model = HierarchicalModel(data['merges'], data['summaries'],
+                data['centroids'], data['counts'], str(data['distance']))
+        model.inserted = data['inserted'].tolist()
+        baseline, total, count = data['drift'].tolist()
+        model.drift = Drift(baseline, total, int(count))
+    return model
+
+# the roots left after undoing the last count - 1 merges
+def cut_tree(merges, n, count):
+    count = max(1, min(count, n))
+    if 1 == count:
+        return [2 * n - 2] if 1 < n else [0]
+    last = merges[n - count:, :2].astype(np.int64).ravel()
+    return sorted(int(node) for node in last if node < 2 * n - count)
@@ -1,11 +1,21 @@
+import blogmatrix
+from collections import namedtuple
+import distances
 from math import sqrt
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 import random
 
 CLUSTER_PIXEL_HEIGHT = 20
 DENDOGRAM_WIDTH = 1200
 
+Layout = namedtuple('Layout', ['leaf_counts', 'depth'])
+
+# binary blog matrices are memory-mapped rather than parsed
 def read_file(filename):
+    if blogmatrix.is_matrix_file(filename):
+        matrix = blogmatrix.open_matrix(filename)
+        return matrix.col_names, matrix.row_names, matrix.to_dense()
     with open(filename, 'r') as fin:
         lines = fin.readlines()
         col_names = lines[0].strip().split('\t')[1:]
@@ -32,7 +42,21 @@ def pearson(v1, v2):
     return 1.0 - (numerator / denominator)
 
 def euclidean(v1, v2):
-    return sqrt(sum([pow(v1[i], 2) + pow(v2[i], 2) for i in range(len(v1))]))
+    return sqrt(sum([pow(v1[i] - v2[i], 2) for i in range(len(v1))]))
+
+# batched equivalents of the scalar distances above
+KERNELS = {pearson: distances.Pearson, euclidean: distances.Euclidean}
+
+def get_kernel(distance):
+    if isinstance(distance, distances.Kernel):
+        return distance
+    if distance in KERNELS:
+        return KERNELS[distance]()
+    return None
+
+def is_euclidean(distance):
+    return distance is euclidean or \
+            isinstance(distance, distances.Euclidean)
 
 class bicluster:
     def __init__(self, vec, left=None, right=None, distance=0.0, id=None):
@@ -42,7 +66,23 @@ class bicluster:
         self.distance = distance
         self.id = id
 
-def hcluster(rows, distance=pearson):
+# with linkage set, compact=True returns a LinkageTree instead of biclusters
+# and candidates (such as lsh.LSHIndex.candidate_pairs()) limits the
+# distances computed to those pairs
+def hcluster(rows, distance=pearson, linkage=None, compact=False,
+        workers=None, candidates=None, far=None):
+    if linkage is not None:
+        if 'centroid' == linkage and not is_euclidean(distance):
+            raise ValueError('centroid linkage needs euclidean distances')
+        if candidates is not None:
+            dist = candidate_distance_matrix(rows, candidates, distance, far)
+        else:
+            dist = distance_matrix(rows, distance, workers)
+        merges = linkage_matrix(dist, len(rows), linkage)
+        if compact:
+            return LinkageTree(merges, rows)
+        return linkage_to_bicluster(merges, rows)
+
     distances = {}
     current_cluster_id = -1
     clusters = [bicluster(rows[i], id=i) for i in range(len(rows))]
@@ -75,151 +115,696 @@ def hcluster(rows, distance=pearson):
         clusters.append(new_cluster)
     return clusters[0]
 
-def print_cluster(cluster, labels=None, n=0):
+# workers only applies to kernels; plain callables are evaluated serially
+def distance_matrix(rows, distance=pearson, workers=None):
+    kernel = get_kernel(distance)
+    if kernel is not None:
+        return kernel.pairwise(rows, workers)
+    n = len(rows)
+    dist = np.empty(n * (n - 1) // 2)
+    k = 0
     for i in range(n):
-        print(' ', end='')
-    if cluster.id < 0:
-        print('-')
+        for j in range(i + 1, n):
+            dist[k] = distance(rows[i], rows[j])
+            k += 1
+    return dist
+
+# pairs that are not candidates get the distance far, which defaults to the
+# largest candidate distance so that they are merged last
+def candidate_distance_matrix(rows, candidates, distance=pearson, far=None):
+    n = len(rows)
+    pairs = np.asarray(candidates, dtype=np.int64).reshape(-1, 2)
+    left = pairs.min(axis=1)
+    right = pairs.max(axis=1)
+    keep = left != right
+    left = left[keep]
+    right = right[keep]
+    kernel = get_kernel(distance)
+    if kernel is not None:
+        values = kernel.paired(rows, left, right)
     else:
-        if labels == None:
-            print(cluster.id)
+        values = np.array([distance(rows[i], rows[j])
+            for i, j in zip(left, right)])
+    if far is None:
+        far = values.max() if len(values) else 0.0
+    dist = np.full(n * (n - 1) // 2, float(far))
+    dist[distances.condensed_row_starts(n)[left] + right] = values
+    return dist
+
+def get_condensed_row(dist, n, i, row_starts):
+    row = np.empty(n)
+    row[:i] = dist[row_starts[:i] + i]
+    row[i] = np.inf
+    row[i + 1:] = dist[row_starts[i] + i + 1:row_starts[i] + n]
+    return row
+
+def set_condensed_row(dist, n, i, row_starts, row):
+    dist[row_starts[:i] + i] = row[:i]
+    dist[row_starts[i] + i + 1:row_starts[i] + n] = row[i + 1:]
+
+# Lance-Williams update of the distances from the merge of a and b
+def lance_williams(linkage, d_a, d_b, d_ab, size_a, size_b):
+    if 'single' == linkage:
+        return np.minimum(d_a, d_b)
+    if 'complete' == linkage:
+        return np.maximum(d_a, d_b)
+    size = size_a + size_b
+    if 'average' == linkage:
+        return (size_a * d_a + size_b * d_b) / size
+    if 'centroid' == linkage:
+        return ((size_a * d_a + size_b * d_b) / size -
+                size_a * size_b * d_ab / (size * size))
+    raise ValueError('unknown linkage ' + str(linkage))
+
+def merge_slots(dist, n, row_starts, sizes, active, a, b, d_ab, linkage):
+    # the merged cluster takes over slot b
+    d_a = get_condensed_row(dist, n, a, row_starts)
+    d_b = get_condensed_row(dist, n, b, row_starts)
+    merged = lance_williams(linkage, d_a, d_b, d_ab, sizes[a], sizes[b])
+    merged[~active] = np.inf
+    active[a] = False
+    merged[a] = np.inf
+    merged[b] = np.inf
+    set_condensed_row(dist, n, b, row_starts, merged)
+    sizes[b] += sizes[a]
+    return merged
+
+# returns an (n - 1) x 4 array of (left, right, distance, size) where
+# cluster n + k is the one created by row k. centroid linkage needs
+# euclidean distances: its update only holds for squared ones, so they are
+# squared in place and the merge distances are square-rooted back.
+def linkage_matrix(dist, n, linkage='average'):
+    if n < 2:
+        return np.empty((0, 4))
+    row_starts = distances.condensed_row_starts(n)
+    sizes = np.ones(n)
+    active = np.ones(n, dtype=bool)
+    if 'centroid' == linkage:
+        np.square(dist, out=dist)
+        merges = label_merges(generic_linkage(dist, n, row_starts, sizes,
+            active, linkage), n)
+        merges[:, 2] = np.sqrt(merges[:, 2])
+        return merges
+    merges = nn_chain_linkage(dist, n, row_starts, sizes, active, linkage)
+    return label_merges(merges, n)
+
+# nearest-neighbour chain; only valid for reducible linkages
+def nn_chain_linkage(dist, n, row_starts, sizes, active, linkage):
+    merges = []
+    chain = []
+    for k in range(n - 1):
+        if not chain:
+            chain.append(int(np.argmax(active)))
+        while True:
+            a = chain[-1]
+            row = get_condensed_row(dist, n, a, row_starts)
+            row[~active] = np.inf
+            c = int(np.argmin(row))
+            # break ties in favour of the previous link to avoid cycles
+            if 1 < len(chain) and row[chain[-2]] == row[c]:
+                c = chain[-2]
+            if 1 < len(chain) and c == chain[-2]:
+                break
+            chain.append(c)
+        a = chain.pop()
+        b = chain.pop()
+        d_ab = row[b]
+        merge_slots(dist, n, row_starts, sizes, active, a, b, d_ab, linkage)
+        merges.append((a, b, d_ab))
+    # merges come out of the chain unordered
+    merges.sort(key=lambda merge: merge[2])
+    return merges
+
+# keeps a nearest neighbour per slot, which copes with the inversions of
+# centroid linkage
+def generic_linkage(dist, n, row_starts, sizes, active, linkage):
+    nearest = np.empty(n, dtype=np.int64)
+    nearest_dist = np.empty(n)
+    for i in range(n):
+        row = get_condensed_row(dist, n, i, row_starts)
+        nearest[i] = np.argmin(row)
+        nearest_dist[i] = row[nearest[i]]
+
+    merges = []
+    for k in range(n - 1):
+        a = int(np.argmin(nearest_dist))
+        b = int(nearest[a])
+        d_ab = nearest_dist[a]
+        merged = merge_slots(dist, n, row_starts, sizes, active, a, b, d_ab,
+                linkage)
+        merges.append((a, b, d_ab))
+        nearest_dist[a] = np.inf
+        if 0 == active.sum() - 1:
+            break
+        nearest[b] = np.argmin(merged)
+        nearest_dist[b] = merged[nearest[b]]
+        for i in np.flatnonzero(active):
+            if i == b:
+                continue
+            if nearest[i] == a or nearest[i] == b:
+                row = get_condensed_row(dist, n, i, row_starts)
+                row[~active] = np.inf
+                nearest[i] = np.argmin(row)
+                nearest_dist[i] = row[nearest[i]]
+            elif merged[i] < nearest_dist[i]:
+                nearest[i] = b
+                nearest_dist[i] = merged[i]
+    return merges
+
+# turn slot merges into cluster ids with a union-find over the slots
+def label_merges(merges, n):
+    parent = list(range(n))
+    cluster_of = list(range(n))
+    sizes = [1] * n
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    result = np.empty((len(merges), 4))
+    for k, (a, b, d) in enumerate(merges):
+        root_a = find(a)
+        root_b = find(b)
+        left = cluster_of[root_a]
+        right = cluster_of[root_b]
+        if right < left:
+            left, right = right, left
+        parent[root_a] = root_b
+        sizes[root_b] += sizes[root_a]
+        cluster_of[root_b] = n + k
+        result[k] = (left, right, d, sizes[root_b])
+    return result
+
+def linkage_to_bicluster(merges, rows):
+    n = len(rows)
+    clusters = [bicluster(rows[i], id=i) for i in range(n)]
+    for k, (left, right, d, size) in enumerate(merges):
+        left = clusters[int(left)]
+        right = clusters[int(right)]
+        merged_vec = [(left.vec[i] + right.vec[i]) / 2.0
+                for i in range(len(left.vec))]
+        clusters.append(bicluster(merged_vec, left=left, right=right,
+            distance=d, id=-(k + 1)))
+    return clusters[-1]
+
+# linkage matrix backed tree; nodes are views created on access and
+# centroids are only computed when asked for
+class LinkageTree:
+    def __init__(self, merges, rows):
+        self.merges = merges
+        self.rows = rows
+        self.n = len(rows)
+
+    def root(self):
+        if 1 == self.n:
+            return LinkageNode(self, 0)
+        return LinkageNode(self, 2 * self.n - 2)
+
+    def members(self, index):
+        result = []
+        stack = [index]
+        while stack:
+            index = stack.pop()
+            if index < self.n:
+                result.append(index)
+                continue
+            merge = self.merges[index - self.n]
+            stack.append(int(merge[1]))
+            stack.append(int(merge[0]))
+        return result
+
+    def centroid(self, index):
+        if index < self.n:
+            return self.rows[index]
+        return np.asarray([self.rows[i] for i in self.members(index)],
+                dtype=float).mean(axis=0)
+
+class LinkageNode:
+    __slots__ = ('tree', 'index')
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    def child(self, column):
+        if self.index < self.tree.n:
+            return None
+        return LinkageNode(self.tree,
+                int(self.tree.merges[self.index - self.tree.n][column]))
+
+    @property
+    def left(self):
+        return self.child(0)
+
+    @property
+    def right(self):
+        return self.child(1)
+
+    @property
+    def distance(self):
+        if self.index < self.tree.n:
+            return 0.0
+        return float(self.tree.merges[self.index - self.tree.n][2])
+
+    @property
+    def id(self):
+        # same numbering as the bicluster tree
+        if self.index < self.tree.n:
+            return self.index
+        return self.tree.n - self.index - 1
+
+    @property
+    def vec(self):
+        return self.tree.centroid(self.index)
+
+def print_cluster(cluster, labels=None, n=0):
+    stack = [(cluster, n)]
+    while stack:
+        cluster, n = stack.pop()
+        for i in range(n):
+            print(' ', end='')
+        if cluster.id < 0:
+            print('-')
         else:
-            print(labels[cluster.id])
-    if cluster.left != None:
-        print_cluster(cluster.left, labels=labels, n=n+1)
-    if cluster.right != None:
-        print_cluster(cluster.right, labels=labels, n=n+1)
+            if labels == None:
+                print(cluster.id)
+            else:
+                print(labels[cluster.id])
+        if cluster.right != None:
+            stack.append((cluster.right, n + 1))
+        if cluster.left != None:
+            stack.append((cluster.left, n + 1))
 
 def get_height(cluster):
-    if cluster.left == None and cluster.right == None:
-        return 1
-    return get_height(cluster.left) + get_height(cluster.right)
+    height = 0
+    stack = [cluster]
+    while stack:
+        cluster = stack.pop()
+        if cluster.left == None and cluster.right == None:
+            height += 1
+            continue
+        stack.append(cluster.left)
+        stack.append(cluster.right)
+    return height
 
 def get_depth(cluster):
-    if cluster.left == None and cluster.right == None:
+    depth = 0.0
+    stack = [(cluster, 0.0)]
+    while stack:
+        cluster, d = stack.pop()
+        if cluster.left == None and cluster.right == None:
+            depth = max(depth, d)
+            continue
+        stack.append((cluster.left, d + cluster.distance))
+        stack.append((cluster.right, d + cluster.distance))
+    return depth
+
+# leaf count of every node, keyed by cluster id, and the depth of the
+# tree, from one iterative walk
+def layout_dendrogram(cluster):
+    leaf_counts = {}
+    depth = 0.0
+    stack = [(cluster, 0.0, False)]
+    while stack:
+        node, d, expanded = stack.pop()
+        if node.left == None and node.right == None:
+            leaf_counts[node.id] = 1
+            depth = max(depth, d)
+            continue
+        if expanded:
+            leaf_counts[node.id] = (leaf_counts[node.left.id] +
+                    leaf_counts[node.right.id])
+            continue
+        stack.append((node, d, True))
+        stack.append((node.right, d + node.distance, False))
+        stack.append((node.left, d + node.distance, False))
+    return Layout(leaf_counts, depth)
+
+# yields ('line', (x1, y1, x2, y2)) and ('label', (x, y, id)) for the part
+# of the dendrogram between y = top and y = bottom; subtrees outside that
+# band are skipped
+def iter_dendrogram(cluster, layout, scaling, x=10, span_top=0.0, top=None,
+        bottom=None):
+    stack = [(cluster, x, span_top)]
+    while stack:
+        node, x, span_top = stack.pop()
+        span_bottom = (span_top +
+                layout.leaf_counts[node.id] * CLUSTER_PIXEL_HEIGHT)
+        if top is not None and span_bottom < top:
+            continue
+        if bottom is not None and bottom < span_top:
+            continue
+        if node.left == None and node.right == None:
+            yield 'label', (x + 5, (span_top + span_bottom) / 2 - 7, node.id)
+            continue
+        h1 = layout.leaf_counts[node.left.id] * CLUSTER_PIXEL_HEIGHT
+        h2 = layout.leaf_counts[node.right.id] * CLUSTER_PIXEL_HEIGHT
+        line_length = node.distance * scaling
+        y1 = span_top + h1 / 2
+        y2 = span_bottom - h2 / 2
+
+        yield 'line', (x, y1, x, y2)
+        yield 'line', (x, y1, x + line_length, y1)
+        yield 'line', (x, y2, x + line_length, y2)
+        stack.append((node.right, x + line_length, span_top + h1))
+        stack.append((node.left, x + line_length, span_top))
+
+def get_scaling(layout, width=DENDOGRAM_WIDTH):
+    if 0 == layout.depth:
         return 0.0
-    return max(get_depth(cluster.left),
-            get_depth(cluster.right)) + cluster.distance
-
-def draw_node(draw, cluster, x, y, scaling, labels, font):
-    if cluster.id < 0:
-        h1 = get_height(cluster.left) * CLUSTER_PIXEL_HEIGHT
-        h2 = get_height(cluster.right) * CLUSTER_PIXEL_HEIGHT
-        top = y - (h1 + h2) / 2
-        bottom = y + (h1 + h2) / 2
-        line_length = cluster.distance * scaling
-
-        draw.line([x, top + h1 / 2, x, bottom - h2 / 2], fill=(255, 0, 0))
-        draw.line([x, top + h1 / 2, x + line_length, top + h1 / 2],
-                fill=(255, 0, 0))
-        draw.line([x, bottom - h2 / 2, x + line_length, bottom - h2 / 2],
-                fill=(255, 0, 0))
-        draw_node(draw, cluster.left, x + line_length, top + h1 / 2,
-                scaling, labels, font)
-        draw_node(draw, cluster.right, x + line_length, bottom - h2 / 2,
-                scaling, labels, font)
-    else:
-        draw.text((x + 5, y - 7), labels[cluster.id], fill=(0, 0, 0),
-                font=font)
+    return float(width - 150) / layout.depth
+
+def draw_primitives(draw, primitives, labels, font, offset=0.0):
+    for kind, value in primitives:
+        if 'line' == kind:
+            draw.line([value[0], value[1] - offset, value[2],
+                value[3] - offset], fill=(255, 0, 0))
+        else:
+            draw.text((value[0], value[1] - offset), labels[value[2]],
+                    fill=(0, 0, 0), font=font)
+
+def draw_node(draw, cluster, x, y, scaling, labels, font, layout=None):
+    if layout is None:
+        layout = layout_dendrogram(cluster)
+    span_top = y - layout.leaf_counts[cluster.id] * CLUSTER_PIXEL_HEIGHT / 2
+    draw_primitives(draw, iter_dendrogram(cluster, layout, scaling, x,
+        span_top), labels, font)
 
 def draw_dendrogram(cluster, labels, font, jpeg='clusters.jpg'):
-    height = get_height(cluster) * CLUSTER_PIXEL_HEIGHT
+    layout = layout_dendrogram(cluster)
+    height = layout.leaf_counts[cluster.id] * CLUSTER_PIXEL_HEIGHT
     width = DENDOGRAM_WIDTH
-    depth = get_depth(cluster)
-    scaling = float (width - 150) / depth
+    scaling = get_scaling(layout, width)
     image = Image.new('RGB', (width, height), (255, 255, 255))
     draw = ImageDraw.Draw(image)
     draw.line([0, height / 2, 10, height / 2], (255, 0, 0))
-    draw_node(draw, cluster, 10, height / 2, scaling, labels, font)
+    draw_node(draw, cluster, 10, height / 2, scaling, labels, font, layout)
     image.save(jpeg, 'JPEG')
 
+# splits a tall dendrogram into images of at most tile_height pixels,
+# named prefix_0000.jpg and so on; returns the file names
+def draw_dendrogram_tiles(cluster, labels, font, prefix='clusters',
+        tile_height=10000):
+    layout = layout_dendrogram(cluster)
+    height = layout.leaf_counts[cluster.id] * CLUSTER_PIXEL_HEIGHT
+    width = DENDOGRAM_WIDTH
+    scaling = get_scaling(layout, width)
+    filenames = []
+    for top in range(0, height, tile_height):
+        bottom = min(top + tile_height, height)
+        image = Image.new('RGB', (width, bottom - top), (255, 255, 255))
+        draw = ImageDraw.Draw(image)
+        if top <= height / 2 <= bottom:
+            draw.line([0, height / 2 - top, 10, height / 2 - top],
+                    (255, 0, 0))
+        # labels may straddle the border, so take a little extra
+        draw_primitives(draw, iter_dendrogram(cluster, layout, scaling,
+            top=top - CLUSTER_PIXEL_HEIGHT,
+            bottom=bottom + CLUSTER_PIXEL_HEIGHT), labels, font, top)
+        filename = '%s_%04d.jpg' % (prefix, len(filenames))
+        image.save(filename, 'JPEG')
+        filenames.append(filename)
+    return filenames
+
+def escape_svg(text):
+    return (str(text).replace('&', '&amp;').replace('<', '&lt;')
+            .replace('>', '&gt;').replace('"', '&quot;'))
+
+# writes the dendrogram element by element without building an image
+def write_dendrogram_svg(cluster, labels, svg='clusters.svg'):
+    layout = layout_dendrogram(cluster)
+    height = layout.leaf_counts[cluster.id] * CLUSTER_PIXEL_HEIGHT
+    width = DENDOGRAM_WIDTH
+    scaling = get_scaling(layout, width)
+    with open(svg, 'w') as out:
+        out.write('<svg xmlns="http://www.w3.org/2000/svg" '
+                'width="%d" height="%d">\n' % (width, height))
+        out.write('<rect width="100%" height="100%" fill="white"/>\n')
+        out.write('<g stroke="red" font-family="DejaVu Sans" '
+                'font-size="12">\n')
+        out.write('<line x1="0" y1="%g" x2="10" y2="%g"/>\n' %
+                (height / 2, height / 2))
+        for kind, value in iter_dendrogram(cluster, layout, scaling):
+            if 'line' == kind:
+                out.write('<line x1="%g" y1="%g" x2="%g" y2="%g"/>\n' %
+                        value)
+            else:
+                out.write('<text x="%g" y="%g" stroke="none" '
+                        'dominant-baseline="hanging">%s</text>\n' %
+                        (value[0], value[1], escape_svg(labels[value[2]])))
+        out.write('</g>\n</svg>\n')
+
+# a view rather than a transposed copy
 def rotate_matrix(data):
-    result = []
-    for i in range(len(data[0])):
-        row = [data[j][i] for j in range(len(data))]
-        result.append(row)
-    return result
+    if isinstance(data, np.ndarray):
+        return data.T
+    return blogmatrix.ColumnView(data)
 
 def average(numbers):
     return sum(numbers) / len(numbers)
 
-def kcluster(rows, k=4, distance=pearson):
+# rows x centroids distances, batched when the distance has a kernel
+def get_centroid_distances(rows, centroids, distance, kernel=None):
+    if kernel is not None:
+        return kernel.many_to_many(rows, centroids)
+    return np.array([[distance(centroid, row) for centroid in centroids]
+        for row in rows])
+
+def random_centroids(rows, k):
     # get the minimum and maximum for each column
     ranges = [(min([row[i] for row in rows]),
             max(row[i] for row in rows)) for i in range(len(rows[0]))]
-    clusters = [[random.random() * (ranges[i][1] - ranges[i][0]) + ranges[i][0]
-        for i in range(len(ranges))] for j in range(k)]
-
-    last_matches = None
-    for t in range(100):
-        best_matches = [[] for i in range(k)]
-
-        for j in range(len(rows)):
-            best_match = 0
-            for i in range(k):
-                d = distance(clusters[i], rows[j])
-                if d < distance(clusters[best_match], rows[j]):
-                    best_match = i
-            best_matches[best_match].append(j)
+    return np.array([[random.random() * (ranges[i][1] - ranges[i][0]) +
+        ranges[i][0] for i in range(len(ranges))] for j in range(k)])
+
+# k-means++: pick each new centroid with probability proportional to the
+# squared distance from the closest centroid chosen so far
+def kmeans_plus_plus_centroids(rows, k, distance=pearson, kernel=None):
+    data = np.asarray(rows, dtype=float)
+    chosen = [random.randrange(len(data))]
+    closest = get_centroid_distances(data, data[chosen], distance,
+            kernel)[:, 0]
+    for i in range(1, k):
+        weights = np.cumsum(np.maximum(closest, 0.0) ** 2)
+        if 0 == weights[-1]:
+            chosen.append(random.randrange(len(data)))
+        else:
+            target = random.random() * weights[-1]
+            chosen.append(min(int(np.searchsorted(weights, target,
+                side='right')), len(data) - 1))
+        closest = np.minimum(closest, get_centroid_distances(data,
+            data[chosen[-1:]], distance, kernel)[:, 0])
+    return data[chosen].copy()
+
+def get_initial_centroids(rows, k, init, distance, kernel):
+    if 'random' == init:
+        return random_centroids(rows, k)
+    if 'k-means++' == init:
+        return kmeans_plus_plus_centroids(rows, k, distance, kernel)
+    raise ValueError('unknown init ' + str(init))
+
+# with return_centroids, also returns the final centroids, which for an
+# empty cluster is where it was left
+def kcluster(rows, k=4, distance=pearson, init='random', tol=0.0,
+        max_iterations=100, return_centroids=False):
+    if max_iterations < 1:
+        raise ValueError('max_iterations must be at least 1')
+    data = np.asarray(rows, dtype=float)
+    kernel = get_kernel(distance)
+    row_stats = kernel.stats(data) if kernel is not None else rows
+    clusters = get_initial_centroids(rows, k, init, distance, kernel)
+
+    last_nearest = None
+    for t in range(max_iterations):
+        nearest = get_centroid_distances(row_stats, clusters, distance,
+                kernel).argmin(axis=1)
 
         # we're done if nothing changed
-        if last_matches == best_matches:
+        if last_nearest is not None and np.array_equal(last_nearest,
+                nearest):
             break
-        last_matches = best_matches
+        last_nearest = nearest
 
         # move clusters
-        for i in range(k):
-            if len(best_matches[i]) == 0:
-                continue
-            match_rows = [rows[j] for j in best_matches[i]]
-            clusters[i] = [average([row[j] for row in match_rows])
-                for j in range(len(rows[0]))]
-
-    return best_matches
-
-def scale_down(rows, distance=pearson, rate=0.01):
-    n = len(rows)
-
-    real_distances = [[distance(rows[i], rows[j]) for i in range(n)]
-            for j in range(n)]
-
-    projections = [[random.random(), random.random()] for i in range(n)]
+        sums = np.zeros(clusters.shape)
+        np.add.at(sums, nearest, data)
+        counts = np.bincount(nearest, minlength=k)
+        moved = clusters.copy()
+        nonempty = 0 < counts
+        moved[nonempty] = sums[nonempty] / counts[nonempty, None]
+        shift = np.sqrt(((moved - clusters) ** 2).sum(axis=1)).max()
+        clusters = moved
+        if shift <= tol:
+            break
 
-    projected_distances = [[0.0 for i in range(n)] for j in range(n)]
+    matches = [np.flatnonzero(nearest == i).tolist() for i in range(k)]
+    if return_centroids:
+        return matches, clusters
+    return matches
+
+# yields random batches from in-memory rows, for minibatch_kcluster
+def sample_row_batches(rows, batch_size=100, iterations=100):
+    data = np.asarray(rows, dtype=float)
+    for t in range(iterations):
+        yield data[random.sample(range(len(data)),
+            min(batch_size, len(data)))]
+
+# each centroid stays the running mean of the rows it absorbed; returns
+# the moved centroids and the new counts
+def absorb_rows(centroids, counts, rows, nearest):
+    sums = np.zeros(centroids.shape)
+    np.add.at(sums, nearest, rows)
+    batch_counts = np.bincount(nearest, minlength=len(centroids))
+    nonempty = 0 < batch_counts
+    moved = np.array(centroids, dtype=float)
+    moved[nonempty] = ((moved[nonempty] * counts[nonempty, None] +
+        sums[nonempty]) / (counts[nonempty] + batch_counts[nonempty])[:,
+            None])
+    return moved, counts + batch_counts
+
+# chunks is any iterable of row blocks, so the rows never have to be in
+# memory together; returns the centroids and the rows absorbed by each
+def minibatch_kcluster(chunks, k=4, distance=pearson, init='k-means++',
+        batch_size=100, tol=0.0, max_iterations=None):
+    kernel = get_kernel(distance)
+    clusters = None
+    counts = np.zeros(k, dtype=np.int64)
+    for t, chunk in enumerate(chunks):
+        if max_iterations is not None and max_iterations <= t:
+            break
+        chunk = np.asarray(chunk, dtype=float)
+        if len(chunk) == 0:
+            continue
+        if batch_size < len(chunk):
+            chunk = chunk[random.sample(range(len(chunk)), batch_size)]
+        if clusters is None:
+            clusters = get_initial_centroids(chunk, k, init, distance,
+                    kernel)
+        nearest = get_centroid_distances(chunk, clusters, distance,
+                kernel).argmin(axis=1)
+
+        moved, counts = absorb_rows(clusters, counts, chunk, nearest)
+        shift = np.sqrt(((moved - clusters) ** 2).sum(axis=1)).max()
+        clusters = moved
+        if 0 < tol and shift <= tol:
+            break
+    return clusters, counts
+
+# same result format as kcluster, for centroids found elsewhere
+def assign_clusters(rows, centroids, distance=pearson):
+    kernel = get_kernel(distance)
+    nearest = get_centroid_distances(rows, centroids, distance,
+            kernel).argmin(axis=1)
+    return [np.flatnonzero(nearest == i).tolist()
+            for i in range(len(centroids))]
+
+def get_projected_distances(projections):
+    norms = (projections * projections).sum(axis=1)
+    squared = norms[:, None] + norms[None, :] - 2.0 * (projections @
+        projections.T)
+    np.fill_diagonal(squared, 0.0)
+    return np.sqrt(np.maximum(squared, 0.0))
+
+# one step of the original gradient descent; returns the new projections
+# and the summed relative error of the old ones
+def gradient_step(real_distances, projections, rate):
+    projected = get_projected_distances(projections)
+    error_terms = np.zeros(real_distances.shape)
+    np.divide(real_distances - projected, real_distances, out=error_terms,
+            where=0 != real_distances)
+    np.fill_diagonal(error_terms, 0.0)
+    weights = np.zeros(real_distances.shape)
+    np.divide(error_terms, projected, out=weights, where=0 != projected)
+    grad = weights.sum(axis=1)[:, None] * projections - weights @ projections
+    return projections + grad * rate, np.abs(error_terms).sum()
+
+# one SMACOF (Guttman transform) step; returns the new projections and
+# the stress of the old ones
+def smacof_step(real_distances, projections):
+    projected = get_projected_distances(projections)
+    b = np.zeros(real_distances.shape)
+    np.divide(-real_distances, projected, out=b, where=0 != projected)
+    np.fill_diagonal(b, 0.0)
+    b[np.diag_indices_from(b)] = -b.sum(axis=1)
+    stress = ((real_distances - projected) ** 2).sum() / 2.0
+    return b @ projections / len(projections), stress
+
+# classical (Torgerson) MDS, used to start SMACOF near a good solution
+def classical_projections(real_distances):
+    squared = real_distances ** 2
+    means = squared.mean(axis=0)
+    gram = -0.5 * (squared - means[:, None] - means[None, :] + means.mean())
+    values, vectors = np.linalg.eigh(gram)
+    top = np.argsort(values)[::-1][:2]
+    return vectors[:, top] * np.sqrt(np.maximum(values[top], 0.0))
+
+def scale_down_matrix(real_distances, method='gradient', rate=0.01, tol=0.0,
+        max_iterations=1000, progress=None):
+    n = len(real_distances)
+    if 'smacof' == method:
+        projections = classical_projections(real_distances)
+    else:
+        projections = np.array([[random.random(), random.random()]
+            for i in range(n)])
 
     last_error = None
+    for m in range(max_iterations):
+        if 'gradient' == method:
+            moved, total_error = gradient_step(real_distances, projections,
+                    rate)
+        elif 'smacof' == method:
+            moved, total_error = smacof_step(real_distances, projections)
+        else:
+            raise ValueError('unknown method ' + str(method))
+        if progress is not None:
+            progress(m, total_error)
 
-    for m in range(0, 1000):
-        total_error = 0.0
-        projected_distances = [[euclidean(projections[i], projections[j])
-            for i in range(n)] for j in range(n)]
-
-        grad = [[0.0, 0.0] for j in range(n)]
-
-        for k in range(n):
-            for j in range(n):
-                if j == k:
-                    continue
-                error_term = (real_distances[k][j] -
-                    projected_distances[k][j]) / real_distances[k][j]
-
-                for i in range(2):
-                    grad[k][i] += ((projections[k][i] - projections[j][i]) /
-                        projected_distances[k][j]) * error_term
-                total_error += abs(error_term)
-        print(total_error)
-
-        if last_error and last_error <= total_error:
+        if last_error is not None and last_error - total_error <= tol:
             break
         last_error = total_error
-
-        # get new projections
-        for k in range(n):
-            for j in range(2):
-                projections[k][j] += grad[k][j] * rate
+        projections = moved
 
     return projections
 
+# landmarks places a sample of rows with full MDS and triangulates the
+# rest from their distances to that sample, so no n x n matrix is built
+def scale_down(rows, distance=pearson, rate=0.01, workers=None,
+        method='gradient', tol=0.0, max_iterations=1000, progress=None,
+        landmarks=None):
+    n = len(rows)
+    kernel = get_kernel(distance)
+
+    if landmarks is None or n <= landmarks:
+        if kernel is not None:
+            real_distances = kernel.square(rows, workers)
+        else:
+            real_distances = np.array([[distance(rows[i], rows[j])
+                for i in range(n)] for j in range(n)])
+        return scale_down_matrix(real_distances, method, rate, tol,
+                max_iterations, progress).tolist()
+
+    data = np.asarray(rows, dtype=float)
+    chosen = sorted(random.sample(range(n), landmarks))
+    to_landmarks = get_centroid_distances(
+            kernel.stats(data) if kernel is not None else rows,
+            data[chosen], distance, kernel)
+    placed = scale_down_matrix(to_landmarks[chosen], method, rate, tol,
+            max_iterations, progress)
+
+    # solve |x - y_i|^2 = d_i^2 for x in the least-squares sense, with the
+    # landmark projections y centred on the origin
+    center = placed.mean(axis=0)
+    placed = placed - center
+    norms = (placed * placed).sum(axis=1)
+    squared = to_landmarks ** 2
+    rhs = -0.5 * (squared - squared.mean(axis=1)[:, None] -
+            (norms - norms.mean())[None, :])
+    projections = rhs @ np.linalg.pinv(placed).T + center
+    projections[chosen] = placed + center
+    return projections.tolist()
+
 def draw_scaled_down_data(data, labels, font, jpeg='mds2d.jpg'):
     img = Image.new('RGB', (2000, 2000), (255, 255, 255))
     draw = ImageDraw.Draw(img)
@@ -243,12 +828,13 @@ def demo_k_means(rows, rownames, k=4):
     print([[rownames[i] for i in clusters[j]] for j in range(k)])
 
 def demo_multidimensional_scaling(rows, rownames, font):
-    projections = scale_down(rows, pearson, 0.01)
+    projections = scale_down(rows, pearson, 0.01,
+            progress=lambda iteration, error: print(error))
     print(projections)
     draw_scaled_down_data(projections, rownames, font)
 
 if __name__ == '__main__':
-    colnames, rownames, rows = read_file('blogdata.tsv')
+    colnames, rownames, rows = read_file('blogdata.bin')
     unicode_font = ImageFont.truetype('DejaVuSans.ttf', 12)
     #demo_ascii_cluster(rows, rownames)
     #demo_dendrogram(rows, rownames, unicode_font)
@@ -1,5 +1,9 @@
+from array import array
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 import math
+import os
+import random
 import sys
 
 headers = [
@@ -25,6 +29,8 @@ my_data=[['slashdot','USA','yes',18,'None'],
 SplitRows = namedtuple('SplitRows', ['attribute_id', 'value', 'matches',
     'mismatches'])
 Row = namedtuple('Row', ['attributes', 'result'])
+TreeOptions = namedtuple('TreeOptions', ['score', 'bins', 'subsets',
+    'max_features', 'random'])
 
 class Node:
     def __init__(self, attribute_id=-1, value=None, results=None,
@@ -44,11 +50,7 @@ def get_rows(rows):
 def split_rows_on_attribute(rows, attribute_id, value):
     results = SplitRows(attribute_id, value, [], [])
     for row in rows:
-        if isinstance(value, int):
-            if value >= row.attributes[attribute_id]:
-                results.matches.append(row)
-                continue
-        if value == row.attributes[attribute_id]:
+        if matches_value(row.attributes[attribute_id], value):
             results.matches.append(row)
             continue
         results.mismatches.append(row)
@@ -61,55 +63,280 @@ def count_results(rows):
         results[row.result] += 1
     return results
 
-def gini_impurity(rows):
-    results = count_results(rows)
+def gini_impurity_of_counts(counts, total):
     gini = 1.0
-    for _, result in results.items():
-        gini -= pow(result / len(rows), 2)
+    for result in counts:
+        gini -= pow(result / total, 2)
     return gini
 
+def entropy_of_counts(counts, total):
+    return -1.0 * sum([(result / total) * math.log(result / total)
+        for result in counts if result])
+
+def gini_impurity(rows):
+    return gini_impurity_of_counts(count_results(rows).values(), len(rows))
+
 def entropy(rows):
-    results = count_results(rows)
-    return -1.0 * sum([(result / len(rows)) * math.log(result / len(rows))
-        for _, result in results.items()])
+    return entropy_of_counts(count_results(rows).values(), len(rows))
 
-def build_tree(rows, score=entropy):
-    if 0 == len(rows):
-        return Node()
-    attribute_num = len(rows[0].attributes)
-    current_score = score(rows)
+# scores that can be computed from class counts alone, which lets
+# build_tree sweep splits without materialising rows
+COUNT_SCORES = {gini_impurity: gini_impurity_of_counts,
+        entropy: entropy_of_counts}
+
+def is_numeric(value):
+    return isinstance(value, int)
+
+# numeric values match anything at or below them and a frozenset of
+# categories matches its members
+def matches_value(observed, value):
+    if is_numeric(value) and value >= observed:
+        return True
+    if isinstance(value, frozenset):
+        return observed in value
+    return value == observed
+
+def format_value(value):
+    if isinstance(value, frozenset):
+        return '{' + ', '.join(sorted(str(v) for v in value)) + '}'
+    return str(value)
+
+def get_information_gain(current_score, score, left, right, total):
+    left_total = sum(left)
+    p = left_total / total
+    return current_score - (p * score(left, left_total) +
+            (1 - p) * score(right, total - left_total))
+
+# sorts the column once and moves rows from the right to the left side in
+# ascending order, so every threshold is scored from running class counts.
+# with bins set, only about that many evenly spaced thresholds are tried.
+def find_numeric_split(rows, indices, attribute_id, classes, totals, score,
+        current_score, bins=None):
+    order = sorted(indices, key=lambda i: rows[i].attributes[attribute_id])
+    left = [0] * len(totals)
+    right = list(totals)
+    n = len(order)
+    step = n / bins if bins else 0
+    next_boundary = step
+    best_gain = 0.0
+    best_value = None
+    for position, i in enumerate(order):
+        c = classes[i]
+        left[c] += 1
+        right[c] -= 1
+        value = rows[i].attributes[attribute_id]
+        if position + 1 == n:
+            break
+        if value == rows[order[position + 1]].attributes[attribute_id]:
+            continue
+        if bins and position + 1 < next_boundary:
+            continue
+        next_boundary = position + 1 + step
+        gain = get_information_gain(current_score, score, left, right, n)
+        if best_gain <= gain:
+            best_gain = gain
+            best_value = value
+    return best_gain, best_value
+
+# class counts of every value of the column at this node, in one pass
+def count_categories(rows, indices, attribute_id, classes, class_num):
+    table = {}
+    for i in indices:
+        value = rows[i].attributes[attribute_id]
+        if value not in table:
+            table[value] = [0] * class_num
+        table[value][classes[i]] += 1
+    return table
+
+# scores each value against the rest from the count table; with subsets
+# set, also orders the values by their share of the node's majority class
+# and sweeps the prefixes of that order, which finds the best two-way
+# grouping exactly for two classes
+def find_categorical_split(rows, indices, attribute_id, classes, totals,
+        score, current_score, subsets=False):
+    table = count_categories(rows, indices, attribute_id, classes,
+            len(totals))
+    n = len(indices)
+    best_gain = 0.0
+    best_value = None
+    for value, left in table.items():
+        right = [total - count for total, count in zip(totals, left)]
+        if 0 == sum(right):
+            continue
+        gain = get_information_gain(current_score, score, left, right, n)
+        if best_gain <= gain:
+            best_gain = gain
+            best_value = value
+
+    if not subsets or len(table) < 3:
+        return best_gain, best_value
+
+    majority = max(range(len(totals)), key=lambda c: totals[c])
+    ordered = sorted(table, key=lambda value: table[value][majority] /
+            sum(table[value]))
+    left = [0] * len(totals)
+    for position, value in enumerate(ordered[:-1]):
+        left = [count + added for count, added in zip(left, table[value])]
+        if 0 == position:
+            continue
+        right = [total - count for total, count in zip(totals, left)]
+        gain = get_information_gain(current_score, score, left, right, n)
+        if best_gain <= gain:
+            best_gain = gain
+            best_value = frozenset(ordered[:position + 1])
+    return best_gain, best_value
+
+# the original search, kept for scores that need the rows themselves
+def find_split_by_values(rows, attribute_id, score, current_score):
+    best_gain = 0.0
+    best_value = None
+    values = set()
+    for row in rows:
+        values.add(row.attributes[attribute_id])
+    for value in values:
+        split = split_rows_on_attribute(rows, attribute_id, value)
+        if 0 == len(split.matches) or 0 == len(split.mismatches):
+            continue
+        p = len(split.matches) / len(rows)
+        information_gain = current_score - (p * score(split.matches) +
+                (1 - p) * score(split.mismatches))
+        if best_gain <= information_gain:
+            best_gain = information_gain
+            best_value = value
+    return best_gain, best_value
+
+def get_attribute_ids(attribute_num, options):
+    if not options.max_features or attribute_num <= options.max_features:
+        return range(attribute_num)
+    return sorted(options.random.sample(range(attribute_num),
+        options.max_features))
+
+def find_best_split(rows, indices, classes, class_num, options):
+    score = options.score
+    totals = [0] * class_num
+    for i in indices:
+        totals[classes[i]] += 1
+    count_score = COUNT_SCORES.get(score)
+    node_rows = None
+    if count_score is None:
+        node_rows = [rows[i] for i in indices]
+        current_score = score(node_rows)
+    else:
+        current_score = count_score(totals, len(indices))
 
     best_gain = 0.0
     best_split = None
+    for attribute_id in get_attribute_ids(len(rows[indices[0]].attributes),
+            options):
+        if node_rows is not None:
+            gain, value = find_split_by_values(node_rows, attribute_id,
+                    score, current_score)
+        elif all(is_numeric(rows[i].attributes[attribute_id])
+                for i in indices):
+            gain, value = find_numeric_split(rows, indices, attribute_id,
+                    classes, totals, count_score, current_score,
+                    options.bins)
+        else:
+            gain, value = find_categorical_split(rows, indices,
+                    attribute_id, classes, totals, count_score,
+                    current_score, options.subsets)
+        if value is not None and best_gain <= gain:
+            best_gain = gain
+            best_split = (attribute_id, value)
+    return best_gain, best_split
 
-    for attribute_id in range(attribute_num):
-        values = set()
-        for row in rows:
-            values.add(row.attributes[attribute_id])
-        for value in values:
-            split = split_rows_on_attribute(rows, attribute_id, value)
-            p = len(split.matches) / len(rows)
-            information_gain = current_score - (p * score(split.matches) +
-                    (1 - p) * score(split.mismatches))
-            if 0 == len(split.matches) or 0 == len(split.mismatches):
-                continue
-            if best_gain <= information_gain:
-                best_gain = information_gain
-                best_split = split
-
-    if 0.0 < best_gain:
-        match_node = build_tree(best_split.matches, score)
-        mismatch_node = build_tree(best_split.mismatches, score)
-        return Node(best_split.attribute_id, best_split.value, None,
-                match_node, mismatch_node)
-    return Node(None, None, rows, None, None)
+# max_features tries only that many randomly chosen attributes at each node,
+# drawn from a generator seeded with seed
+def get_tree_options(score=entropy, bins=None, subsets=False,
+        max_features=None, seed=None):
+    return TreeOptions(score, bins, subsets, max_features,
+            random.Random(seed) if max_features else None)
+
+def get_classes(rows):
+    class_ids = {}
+    classes = [class_ids.setdefault(row.result, len(class_ids))
+            for row in rows]
+    return classes, len(class_ids)
+
+def build_tree(rows, score=entropy, bins=None, subsets=False,
+        max_features=None, seed=None):
+    if 0 == len(rows):
+        return Node()
+    classes, class_num = get_classes(rows)
+    return grow_tree(rows, list(range(len(rows))), classes, class_num,
+            get_tree_options(score, bins, subsets, max_features, seed))
+
+# returns the match and mismatch indices of the best split, or None
+def split_indices(rows, indices, classes, class_num, options):
+    best_gain, best_split = find_best_split(rows, indices, classes,
+            class_num, options)
+    if not 0.0 < best_gain:
+        return None
+    attribute_id, value = best_split
+    matches = []
+    mismatches = []
+    for i in indices:
+        if matches_value(rows[i].attributes[attribute_id], value):
+            matches.append(i)
+        else:
+            mismatches.append(i)
+    return attribute_id, value, matches, mismatches
+
+# works on lists of row indices; rows are only gathered at the leaves
+def grow_tree(rows, indices, classes, class_num, options):
+    split = split_indices(rows, indices, classes, class_num, options)
+    if split is None:
+        return Node(None, None, [rows[i] for i in indices], None, None)
+    attribute_id, value, matches, mismatches = split
+    match_node = grow_tree(rows, matches, classes, class_num, options)
+    mismatch_node = grow_tree(rows, mismatches, classes, class_num, options)
+    return Node(attribute_id, value, None, match_node, mismatch_node)
+
+# splits the top of the tree here until there are enough independent
+# subtrees to keep the workers busy, then builds those in a process pool
+def build_tree_parallel(rows, score=entropy, bins=None, subsets=False,
+        workers=None, min_rows=1000):
+    if 0 == len(rows):
+        return Node()
+    workers = workers or os.cpu_count() or 1
+    classes, class_num = get_classes(rows)
+    options = get_tree_options(score, bins, subsets)
+    root = Node()
+    # nodes still to be built, as (node, indices) with node a placeholder
+    pending = [(root, list(range(len(rows))))]
+    ready = []
+    while pending and len(pending) + len(ready) < 2 * workers:
+        pending.sort(key=lambda entry: len(entry[1]))
+        node, indices = pending.pop()
+        if len(indices) < min_rows:
+            ready.append((node, indices))
+            continue
+        split = split_indices(rows, indices, classes, class_num, options)
+        if split is None:
+            node.attribute_id = None
+            node.results = [rows[i] for i in indices]
+            continue
+        node.attribute_id, node.value, matches, mismatches = split
+        node.match_node = Node()
+        node.mismatch_node = Node()
+        pending.append((node.match_node, matches))
+        pending.append((node.mismatch_node, mismatches))
+    ready.extend(pending)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [(node, pool.submit(build_tree,
+            [rows[i] for i in indices], score, bins, subsets))
+            for node, indices in ready]
+        for node, future in futures:
+            node.__dict__.update(future.result().__dict__)
+    return root
 
 def print_tree(node, indent=''):
     if node.results:
         print(count_results(node.results))
         return
     assert 0 <= node.attribute_id
-    print(headers[node.attribute_id] + ': ' + str(node.value) + '?')
+    print(headers[node.attribute_id] + ': ' + format_value(node.value) + '?')
     sys.stdout.write(indent + 'true-> ')
     print_tree(node.match_node, indent + '    ')
     sys.stdout.write(indent + 'false-> ')
@@ -118,10 +345,7 @@ def print_tree(node, indent=''):
 def classify(tree, observation):
     if tree.results:
         return count_results(tree.results)
-    if isinstance(tree.value, int):
-        if observation[tree.attribute_id] >= tree.value:
-            return classify(tree.match_node, observation)
-    if observation[tree.attribute_id] == tree.value:
+    if matches_value(observation[tree.attribute_id], tree.value):
         return classify(tree.match_node, observation)
     return classify(tree.mismatch_node, observation)
 
@@ -145,11 +369,186 @@ def prune(tree, max_gain, score=entropy):
     if tree.mismatch_node:
         prune(tree.mismatch_node, max_gain, score)
 
+# node kinds of a compiled tree
+LEAF = 0
+NUMERIC = 1
+CATEGORY = 2
+SUBSET = 3
+
+# a trained tree flattened into parallel arrays indexed by node, with node 0
+# the root. match and mismatch hold child indices, value holds the numeric
+# threshold, category holds a code into strings (or into subsets, a list of
+# frozensets of codes), and leaf nodes keep the class counts of their rows
+# instead of the rows themselves: leaf l owns the entries
+# leaf_starts[l]:leaf_starts[l + 1] of leaf_classes (codes into classes)
+# and leaf_counts, in the order the classes first appeared in its rows.
+class CompiledTree:
+    def __init__(self, kinds, attributes, values, categories, match,
+            mismatch, leaves, leaf_starts, leaf_classes, leaf_counts,
+            classes, strings, subsets, headers=None):
+        self.kinds = kinds
+        self.attributes = attributes
+        self.values = values
+        self.categories = categories
+        self.match = match
+        self.mismatch = mismatch
+        self.leaves = leaves
+        self.leaf_starts = leaf_starts
+        self.leaf_classes = leaf_classes
+        self.leaf_counts = leaf_counts
+        self.classes = classes
+        self.strings = strings
+        self.subsets = subsets
+        self.headers = headers
+        self.codes = dict((value, code) for code, value in enumerate(strings))
+        # leaf distributions are built on first use so loading stays cheap
+        self.distributions = {}
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def leaf_num(self):
+        return len(self.leaf_starts) - 1
+
+    def get_distribution(self, leaf):
+        distribution = self.distributions.get(leaf)
+        if distribution is None:
+            start, end = self.leaf_starts[leaf], self.leaf_starts[leaf + 1]
+            distribution = dict((self.classes[c], count) for c, count in
+                    zip(self.leaf_classes[start:end],
+                        self.leaf_counts[start:end]))
+            self.distributions[leaf] = distribution
+        return distribution
+
+    def get_leaf(self, observation):
+        node = 0
+        while True:
+            kind = self.kinds[node]
+            if LEAF == kind:
+                return node
+            observed = observation[self.attributes[node]]
+            if NUMERIC == kind:
+                matched = observed <= self.values[node]
+            elif CATEGORY == kind:
+                matched = self.codes.get(observed, -1) == \
+                        self.categories[node]
+            else:
+                matched = self.codes.get(observed, -1) in \
+                        self.subsets[self.categories[node]]
+            node = self.match[node] if matched else self.mismatch[node]
+
+    def classify(self, observation):
+        return dict(self.get_distribution(self.leaves[
+            self.get_leaf(observation)]))
+
+    # the value a node tests, as print_tree shows it
+    def get_value(self, node):
+        kind = self.kinds[node]
+        if NUMERIC == kind:
+            value = self.values[node]
+            return int(value) if value.is_integer() else value
+        if CATEGORY == kind:
+            return self.strings[self.categories[node]]
+        return frozenset(self.strings[code]
+                for code in self.subsets[self.categories[node]])
+
+# prints a compiled tree exactly like print_tree prints the tree it was
+# compiled from
+def print_compiled_tree(compiled, column_names=None):
+    column_names = column_names or compiled.headers or headers
+    stack = [(0, '', '')]
+    while stack:
+        node, indent, prefix = stack.pop()
+        sys.stdout.write(prefix)
+        if LEAF == compiled.kinds[node]:
+            print(compiled.get_distribution(compiled.leaves[node]))
+            continue
+        print(column_names[compiled.attributes[node]] + ': ' +
+                format_value(compiled.get_value(node)) + '?')
+        stack.append((compiled.mismatch[node], indent + '    ',
+            indent + 'false-> '))
+        stack.append((compiled.match[node], indent + '    ',
+            indent + 'true-> '))
+
+def compile_tree(tree):
+    kinds = array('b')
+    attributes = array('i')
+    values = array('d')
+    categories = array('i')
+    match = array('i')
+    mismatch = array('i')
+    leaves = array('i')
+    leaf_counts = []
+    classes = {}
+    codes = {}
+    subsets = []
+
+    def get_code(value):
+        return codes.setdefault(value, len(codes))
+
+    # nodes are numbered in pre-order; children are patched in once known
+    stack = [(tree, -1, None)]
+    while stack:
+        node, parent, side = stack.pop()
+        index = len(kinds)
+        if parent >= 0:
+            side[parent] = index
+        kind = LEAF
+        attribute = -1
+        value = 0.0
+        category = -1
+        leaf = -1
+        if node.results is not None or node.match_node is None:
+            results = count_results(node.results or [])
+            for result in results:
+                classes.setdefault(result, len(classes))
+            leaf = len(leaf_counts)
+            leaf_counts.append(results)
+        else:
+            attribute = node.attribute_id
+            if is_numeric(node.value):
+                kind = NUMERIC
+                value = node.value
+            elif isinstance(node.value, frozenset):
+                kind = SUBSET
+                category = len(subsets)
+                subsets.append(frozenset(get_code(v) for v in node.value))
+            else:
+                kind = CATEGORY
+                category = get_code(node.value)
+        kinds.append(kind)
+        attributes.append(attribute)
+        values.append(value)
+        categories.append(category)
+        match.append(-1)
+        mismatch.append(-1)
+        leaves.append(leaf)
+        if LEAF != kind:
+            stack.append((node.mismatch_node, index, mismatch))
+            stack.append((node.match_node, index, match))
+
+    leaf_starts = array('i', [0])
+    leaf_classes = array('i')
+    counts = array('q')
+    for results in leaf_counts:
+        leaf_classes.extend(classes[result] for result in results)
+        counts.extend(results.values())
+        leaf_starts.append(len(counts))
+    return CompiledTree(kinds, attributes, values, categories, match,
+            mismatch, leaves, leaf_starts, leaf_classes, counts,
+            sorted(classes, key=classes.get), sorted(codes, key=codes.get),
+            subsets)
+
+def classify_batch(compiled, observations):
+    return [compiled.classify(observation) for observation in observations]
+
 if __name__ == '__main__':
     rows = get_rows(my_data)
     tree = build_tree(rows, entropy)
     print_tree(tree)
     print(classify(tree, ['Google', 'USA', 'yes', 30]))
+    print(classify_batch(compile_tree(tree), [['Google', 'USA', 'yes', 30]]))
+    print_compiled_tree(compile_tree(tree))
     prune(tree, 1.5)
     print_tree(tree)
 
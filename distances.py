@@ -0,0 +1,229 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import os
+import tempfile
+
+# number of set bits in every byte value
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+# upper bound on the bytes touched by one block of a bitset comparison
+BITSET_BLOCK_BYTES = 1 << 24
+# rows per side of a tile of the pairwise matrix
+TILE_SIZE = 512
+
+# the condensed matrix stores d(i, j) for i < j at row_starts[i] + j
+def condensed_row_starts(n):
+    i = np.arange(n, dtype=np.int64)
+    return n * i - i * (i + 1) // 2 - i - 1
+
+# per-row statistics computed once and reused for every comparison
+class RowStats:
+    def __init__(self, rows):
+        self.data = np.asarray(rows, dtype=float)
+        if 1 == self.data.ndim:
+            self.data = self.data.reshape(1, -1)
+        self.sums = self.data.sum(axis=1)
+        self.squares = np.einsum('ij,ij->i', self.data, self.data)
+        self.means = self.sums / self.data.shape[1]
+        self.norms = np.sqrt(self.squares)
+        # square root of the pearson denominator term of each row
+        self.spreads = np.sqrt(np.maximum(
+            self.squares - self.sums * self.sums / self.data.shape[1], 0.0))
+
+    def __len__(self):
+        return len(self.data)
+
+    def take(self, indices):
+        result = RowStats.__new__(RowStats)
+        for name in ('data', 'sums', 'squares', 'means', 'norms', 'spreads'):
+            setattr(result, name, getattr(self, name)[indices])
+        return result
+
+class BitRows:
+    def __init__(self, rows):
+        data = np.asarray(rows)
+        if 1 == data.ndim:
+            data = data.reshape(1, -1)
+        self.bits = np.packbits(data > 0, axis=1)
+        self.counts = POPCOUNT[self.bits].sum(axis=1, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.bits)
+
+    def take(self, indices):
+        result = BitRows.__new__(BitRows)
+        result.bits = self.bits[indices]
+        result.counts = self.counts[indices]
+        return result
+
+class Kernel:
+    row_type = RowStats
+
+    def stats(self, rows):
+        if isinstance(rows, self.row_type):
+            return rows
+        return self.row_type(rows)
+
+    def __call__(self, v1, v2):
+        return float(self.many_to_many([v1], [v2])[0, 0])
+
+    def one_to_many(self, v, rows):
+        return self.many_to_many([v], rows)[0]
+
+    def many_to_many(self, a, b):
+        return self.compare(self.stats(a), self.stats(b))
+
+    # condensed upper triangle, in the order used by clusters.hcluster
+    def pairwise(self, rows, workers=None):
+        return tiled_distances(self, rows, 'condensed', workers)
+
+    # full symmetric n x n matrix
+    def square(self, rows, workers=None):
+        return tiled_distances(self, rows, 'square', workers)
+
+    # d(rows[left[k]], rows[right[k]]) for every k
+    def paired(self, rows, left, right, block=TILE_SIZE * TILE_SIZE):
+        stats = self.stats(rows)
+        result = np.empty(len(left))
+        for start in range(0, len(left), block):
+            end = min(start + block, len(left))
+            result[start:end] = self.compare_paired(
+                    stats.take(left[start:end]), stats.take(right[start:end]))
+        return result
+
+def get_tiles(n, tile_size):
+    return [(i, j) for i in range(0, n, tile_size)
+            for j in range(i, n, tile_size)]
+
+# serial and parallel runs compute exactly the same tiles, so their
+# results are bit-identical
+def compute_tile(kernel, stats, out, mode, tile, tile_size):
+    n = len(stats)
+    i0, j0 = tile
+    i1 = min(i0 + tile_size, n)
+    j1 = min(j0 + tile_size, n)
+    block = kernel.compare(stats.take(slice(i0, i1)),
+            stats.take(slice(j0, j1)))
+    if 'square' == mode:
+        out[i0:i1, j0:j1] = block
+        out[j0:j1, i0:i1] = block.T
+        return
+    row_starts = condensed_row_starts(n)
+    for i in range(i0, i1):
+        start = max(j0, i + 1)
+        if start < j1:
+            out[row_starts[i] + start:row_starts[i] + j1] = \
+                    block[i - i0, start - j0:]
+
+def get_output_shape(n, mode):
+    if 'square' == mode:
+        return (n, n)
+    return (n * (n - 1) // 2,)
+
+def tiled_distances(kernel, rows, mode, workers=None, tile_size=TILE_SIZE):
+    data = np.ascontiguousarray(rows, dtype=float)
+    n = len(data)
+    tiles = get_tiles(n, tile_size)
+    shape = get_output_shape(n, mode)
+    if not workers or workers <= 1 or len(tiles) <= 1:
+        out = np.empty(shape)
+        stats = kernel.stats(data)
+        for tile in tiles:
+            compute_tile(kernel, stats, out, mode, tile, tile_size)
+        return out
+
+    # the workers write straight into a memory-mapped temporary file that
+    # becomes the result, so the output is never held twice. the file is
+    # removed once the workers are done; the mapping keeps its pages.
+    source = shared_memory.SharedMemory(create=True, size=max(1, data.nbytes))
+    handle, target_path = tempfile.mkstemp(suffix='.dist')
+    os.close(handle)
+    try:
+        out = np.memmap(target_path, dtype=float, mode='w+', shape=shape)
+        np.ndarray(data.shape, dtype=float, buffer=source.buf)[:] = data
+        with ProcessPoolExecutor(max_workers=workers,
+                initializer=attach_tile_worker,
+                initargs=(kernel, source.name, data.shape, target_path,
+                    shape, mode, tile_size)) as pool:
+            # consume the results so worker errors are raised here
+            for _ in pool.map(run_tile_worker, tiles,
+                    chunksize=max(1, len(tiles) // (4 * workers))):
+                pass
+        return out
+    finally:
+        source.close()
+        source.unlink()
+        os.remove(target_path)
+
+# state of a pool worker, set up once by attach_tile_worker
+tile_worker = {}
+
+def attach_tile_worker(kernel, source_name, source_shape, target_path,
+        target_shape, mode, tile_size):
+    source = shared_memory.SharedMemory(name=source_name)
+    data = np.ndarray(source_shape, dtype=float, buffer=source.buf)
+    tile_worker.update(kernel=kernel, source=source,
+            stats=kernel.stats(data), mode=mode, tile_size=tile_size,
+            out=np.memmap(target_path, dtype=float, mode='r+',
+                shape=target_shape))
+
+def run_tile_worker(tile):
+    compute_tile(tile_worker['kernel'], tile_worker['stats'],
+            tile_worker['out'], tile_worker['mode'], tile,
+            tile_worker['tile_size'])
+
+class Pearson(Kernel):
+    def compare(self, a, b):
+        m = a.data.shape[1]
+        numerator = a.data @ b.data.T - np.outer(a.sums, b.sums) / m
+        denominator = np.outer(a.spreads, b.spreads)
+        result = np.zeros(numerator.shape)
+        nonzero = 0 != denominator
+        result[nonzero] = 1.0 - numerator[nonzero] / denominator[nonzero]
+        return result
+
+    def compare_paired(self, a, b):
+        m = a.data.shape[1]
+        numerator = (np.einsum('ij,ij->i', a.data, b.data) -
+                a.sums * b.sums / m)
+        denominator = a.spreads * b.spreads
+        result = np.zeros(numerator.shape)
+        nonzero = 0 != denominator
+        result[nonzero] = 1.0 - numerator[nonzero] / denominator[nonzero]
+        return result
+
+class Euclidean(Kernel):
+    def compare(self, a, b):
+        squared = (a.squares[:, None] + b.squares[None, :] -
+                2.0 * (a.data @ b.data.T))
+        return np.sqrt(np.maximum(squared, 0.0))
+
+    def compare_paired(self, a, b):
+        squared = (a.squares + b.squares -
+                2.0 * np.einsum('ij,ij->i', a.data, b.data))
+        return np.sqrt(np.maximum(squared, 0.0))
+
+# for binary word-presence vectors; any non-zero count is a set bit
+class Tanimoto(Kernel):
+    row_type = BitRows
+
+    def compare(self, a, b):
+        result = np.empty((len(a), len(b)))
+        block = max(1, BITSET_BLOCK_BYTES //
+                max(1, len(b) * a.bits.shape[1]))
+        for start in range(0, len(a), block):
+            end = min(start + block, len(a))
+            shared = POPCOUNT[a.bits[start:end, None, :] &
+                    b.bits[None, :, :]].sum(axis=2, dtype=np.int64)
+            union = a.counts[start:end, None] + b.counts[None, :] - shared
+            similarity = np.ones(shared.shape)
+            np.divide(shared, union, out=similarity, where=0 != union)
+            result[start:end] = 1.0 - similarity
+        return result
+
+    def compare_paired(self, a, b):
+        shared = POPCOUNT[a.bits & b.bits].sum(axis=1, dtype=np.int64)
+        union = a.counts + b.counts - shared
+        similarity = np.ones(shared.shape)
+        np.divide(shared, union, out=similarity, where=0 != union)
+        return 1.0 - similarity
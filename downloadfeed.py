@@ -1,56 +1,214 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import feedparser
+import hashlib
 import json
-import re
-from strip_html_tags import strip_html_tags
+import os
+import requests
+import threading
+import tokenizer
+import wordstore
 
-# get title and dictionary of word counts of RSS feed
-def get_word_counts(url):
-    data = feedparser.parse(url)
+CACHE_DIR = 'feedcache'
+TIMEOUT = 10
+MAX_WORKERS = 8
+
+# status is 'fetched' when the feed changed since the cached copy,
+# 'unchanged' when it did not (content is then the cached copy) and
+# 'failed' when it could not be fetched (content is then the cached copy,
+# or None if there is none). etag and modified are the
+# validators a fetched feed came with, for FeedCache.commit
+FetchResult = namedtuple('FetchResult', ['url', 'status', 'content', 'etag',
+    'modified'], defaults=(None, None))
+
+# the last copy of every feed, with the validators that let the next run
+# ask the server whether it changed: ETag, Last-Modified and a hash of the
+# content for servers that send neither
+class FeedCache:
+    def __init__(self, directory=CACHE_DIR):
+        self.directory = directory
+        self.index_file = os.path.join(directory, 'index.json')
+        os.makedirs(directory, exist_ok=True)
+        self.entries = {}
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'r') as fin:
+                self.entries = json.load(fin)
+
+    def get_path(self, url):
+        return os.path.join(self.directory,
+                hashlib.sha1(url.encode('utf-8')).hexdigest() + '.xml')
+
+    def get_headers(self, url):
+        entry = self.entries.get(url)
+        if entry is None or not os.path.exists(self.get_path(url)):
+            return {}
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('modified'):
+            headers['If-Modified-Since'] = entry['modified']
+        return headers
+
+    def read(self, url):
+        if url not in self.entries:
+            return None
+        try:
+            with open(self.get_path(url), 'rb') as fin:
+                return fin.read()
+        except OSError:
+            return None
+
+    def is_changed(self, url, content):
+        return self.entries.get(url, {}).get('hash') != \
+                hashlib.sha256(content).hexdigest() or \
+                not os.path.exists(self.get_path(url))
+
+    # stores a new copy; returns False when the content is the cached one
+    def update(self, url, content, etag=None, modified=None):
+        digest = hashlib.sha256(content).hexdigest()
+        changed = self.is_changed(url, content)
+        if changed:
+            with open(self.get_path(url), 'wb') as out:
+                out.write(content)
+        self.entries[url] = {'etag': etag, 'modified': modified,
+                'hash': digest}
+        return changed
+
+    # records a fetched feed once its content has been used, so that a feed
+    # whose content was never used is fetched again on the next run
+    def commit(self, result):
+        self.update(result.url, result.content, result.etag, result.modified)
+        self.save()
+
+    def save(self):
+        temp_file = self.index_file + '.tmp'
+        with open(temp_file, 'w') as out:
+            json.dump(self.entries, out)
+        os.replace(temp_file, self.index_file)
+
+# requests sessions are not thread-safe, so each worker keeps its own
+session_local = threading.local()
+
+def get_session():
+    if not hasattr(session_local, 'session'):
+        session_local.session = requests.Session()
+    return session_local.session
+
+# conditional GET; returns the response, or None on 304 Not Modified
+def fetch_feed(url, headers, timeout=TIMEOUT):
+    response = get_session().get(url, headers=headers, timeout=timeout)
+    if 304 == response.status_code:
+        return None
+    response.raise_for_status()
+    return response
+
+# fetches the feeds with at most max_workers requests in flight. the cache
+# is only touched from the calling thread, and fetched feeds are not stored
+# in it until they are passed to FeedCache.commit. results are in the order
+# of urls
+def fetch_feeds(urls, cache, max_workers=MAX_WORKERS, timeout=TIMEOUT):
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = dict((pool.submit(fetch_feed, url, cache.get_headers(url),
+            timeout), url) for url in urls)
+        for future in as_completed(futures):
+            url = futures[future]
+            try:
+                response = future.result()
+            except (requests.RequestException, ValueError):
+                # ValueError: a malformed url, like an empty host label
+                results[url] = FetchResult(url, 'failed', cache.read(url))
+                continue
+            if response is None:
+                results[url] = FetchResult(url, 'unchanged', cache.read(url))
+                continue
+            etag = response.headers.get('ETag')
+            modified = response.headers.get('Last-Modified')
+            if cache.is_changed(url, response.content):
+                results[url] = FetchResult(url, 'fetched', response.content,
+                        etag, modified)
+                continue
+            # same content as the committed copy, only the validators move
+            cache.update(url, response.content, etag, modified)
+            results[url] = FetchResult(url, 'unchanged', response.content)
+    cache.save()
+    return [results[url] for url in urls]
+
+def read_feed_list(filename):
+    with open(filename, 'r') as fin:
+        return [line.strip() for line in fin if line.strip()]
+
+def get_entry_text(entry):
+    if 'summary' in entry:
+        summary = entry.summary
+    elif 'description' in entry:
+        summary = entry.description
+    else:
+        summary = ''
+    return entry.get('title', '') + ' ' + summary
+
+# entries are recognised by their id, falling back to the link and then to
+# a hash of their text for feeds that give neither
+def get_entry_key(entry):
+    key = entry.get('id') or entry.get('link')
+    if key:
+        return key
+    return hashlib.sha1(get_entry_text(entry).encode('utf-8')).hexdigest()
+
+def count_words(text):
+    word_count = {}
+    for word in get_words(text):
+        word_count.setdefault(word, 0)
+        word_count[word] += 1
+    return word_count
+
+# get title and dictionary of word counts of RSS feed; source is a url or
+# the content of a feed
+def get_word_counts(source):
+    data = feedparser.parse(source)
     word_count = {}
     for entry in data.entries:
-        if 'summary' in entry:
-            summary = entry.summary
-        elif 'description' in entry:
-            summary = entry.description
-        else:
-            summary = ''
-
-        words = get_words(entry.title + ' ' + summary)
-        for word in words:
+        for word, count in count_words(get_entry_text(entry)).items():
             word_count.setdefault(word, 0)
-            word_count[word] += 1
+            word_count[word] += count
 
     return data.feed.title, word_count
 
+# adds the entries of a feed the store has not seen; only those are
+# tokenized. returns the number of new entries
+def update_store(store, url, content):
+    data = feedparser.parse(content)
+    feed_id = store.get_feed_id(url, data.feed.get('title', url))
+    added = 0
+    for entry in data.entries:
+        key = get_entry_key(entry)
+        if store.has_entry(feed_id, key):
+            continue
+        store.add_entry(feed_id, key, count_words(get_entry_text(entry)))
+        added += 1
+    store.commit()
+    return added
+
 def get_words(html):
-    string = strip_html_tags(html)
-    # split words by non-alpha-numeric characters
-    words = re.compile(r'[^A-Z^a-z^0-9]+').split(html)
-    return [word.lower() for word in words if word != '']
+    return tokenizer.tokenize(html)
 
 if __name__ == '__main__':
 
     RSS_FEED_LIST = 'feedlist.txt'
-    WORD_COUNT_OUT = 'wordcount.json'
-    BLOG_COUNT_OUT = 'blogcount.json'
 
-    word_counts = {}
-    # number of blogs each word appeared in
-    blog_counts = {}
-
-    with open(RSS_FEED_LIST, 'r') as feed:
-        for url in feed:
+    # feeds that did not change since the last run have nothing new; a
+    # feed that failed, or whose entries did not make it into the store, is
+    # retried on the next run
+    cache = FeedCache()
+    with wordstore.WordStore() as store:
+        for result in fetch_feeds(read_feed_list(RSS_FEED_LIST), cache):
+            if 'fetched' != result.status:
+                if 'failed' == result.status:
+                    print('failed to open ' + result.url)
+                continue
             try:
-                title, word_count = get_word_counts(url)
-                word_counts[title] = word_count
-                for word in word_count.keys():
-                    blog_counts.setdefault(word, 0)
-                    blog_counts[word] += 1
+                added = update_store(store, result.url, result.content)
+                cache.commit(result)
+                print('%d new entries in %s' % (added, result.url))
             except:
-                print('failed to open ' + url)
-
-    with open(WORD_COUNT_OUT, 'w') as out:
-        json.dump(word_counts, out)
-    with open(BLOG_COUNT_OUT, 'w') as out:
-        json.dump(blog_counts, out)
-
+                print('failed to read ' + result.url)
@@ -1,8 +1,10 @@
-import json
+import wordstore
 
 MAX_FREQUENCY = 0.11
 MIN_FREQUENCY = 0.10
 
+# blog_counts maps words to the number of blogs they appear in; it can be a
+# dict or a view of a wordstore.WordStore, which is streamed
 def make_word_list(blog_counts):
     word_list = []
 
@@ -18,13 +20,10 @@ def make_word_list(blog_counts):
         
 if __name__ == '__main__':
 
-    BLOG_COUNT_IN = 'blogcount.json'
     WORD_LIST_OUT = 'wordlist.tsv'
 
-    with open(BLOG_COUNT_IN, 'r') as blog_count_in:
-        blog_count = json.load(blog_count_in)
-
-    word_list = make_word_list(blog_count)
+    with wordstore.WordStore() as store:
+        word_list = make_word_list(store.blog_counts())
 
     with open(WORD_LIST_OUT, 'w') as word_list_out:
         for word in word_list:
@@ -1,7 +1,18 @@
+import blogmatrix
 import csv
-import json
+import wordstore
+
+# word_counts maps blogs to their word counts, a dict or the streamed view
+# of a wordstore.WordStore. layout is 'tsv' or one of the binary blogmatrix
+# layouts, 'dense' or 'csr'
+def make_blog_data(word_list, word_counts, dst, layout='tsv'):
+    if 'tsv' != layout:
+        with blogmatrix.MatrixWriter(dst, word_list, layout) as writer:
+            for blog, word_count in word_counts.items():
+                writer.write_row(blog, [word_count.get(word, 0)
+                    for word in word_list])
+        return
 
-def make_blog_data(word_list, word_counts, dst):
     with open(dst, 'w') as out:
         writer = csv.writer(out, delimiter='\t')
         writer.writerow(['blog'] + word_list)
@@ -17,13 +28,10 @@ def make_blog_data(word_list, word_counts, dst):
 if __name__ == '__main__':
 
     WORD_LIST = 'wordlist.tsv'
-    WORD_COUNTS = 'wordcount.json'
-    BLOG_DATA = 'blogdata.tsv'
+    BLOG_DATA = 'blogdata.bin'
 
     with open(WORD_LIST, 'r') as word_list_in:
         word_list = word_list_in.read().splitlines()
 
-    with open(WORD_COUNTS, 'r') as word_counts_in:
-        word_counts = json.load(word_counts_in)
-
-    make_blog_data(word_list, word_counts, BLOG_DATA)
+    with wordstore.WordStore() as store:
+        make_blog_data(word_list, store.word_counts(), BLOG_DATA, 'dense')
@@ -0,0 +1,122 @@
+import numpy as np
+
+# signed random projections: each of the bands hashes rows_per_band
+# hyperplane signs into one code, and rows sharing a code in any band are
+# candidate neighbours. pearson centres the rows first, so that cosine
+# similarity of the stored vectors is their correlation.
+class LSHIndex:
+    def __init__(self, rows=None, bands=16, rows_per_band=8,
+            metric='pearson', seed=None):
+        if not 0 < rows_per_band <= 64:
+            raise ValueError('rows_per_band must be between 1 and 64')
+        if metric not in ('pearson', 'cosine'):
+            raise ValueError('unknown metric ' + str(metric))
+        self.bands = bands
+        self.rows_per_band = rows_per_band
+        self.metric = metric
+        self.seed = seed
+        self.planes = None
+        self.vectors = None
+        self.order = None
+        self.sorted_codes = None
+        if rows is not None:
+            self.build(rows)
+
+    def normalize(self, rows):
+        data = np.asarray(rows, dtype=float)
+        if 'pearson' == self.metric:
+            data = data - data.mean(axis=-1, keepdims=True)
+        norms = np.linalg.norm(data, axis=-1, keepdims=True)
+        return np.divide(data, norms, out=np.zeros(data.shape),
+                where=0 != norms)
+
+    def get_codes(self, vectors):
+        bits = (vectors @ self.planes.T >= 0).reshape(len(vectors),
+                self.bands, self.rows_per_band)
+        weights = np.left_shift(np.uint64(1),
+                np.arange(self.rows_per_band, dtype=np.uint64))
+        return (bits.astype(np.uint64) * weights).sum(axis=2,
+                dtype=np.uint64)
+
+    def build(self, rows):
+        vectors = self.normalize(rows)
+        rng = np.random.default_rng(self.seed)
+        self.planes = rng.standard_normal(
+                (self.bands * self.rows_per_band, vectors.shape[1]))
+        self.vectors = vectors.astype(np.float32)
+        codes = self.get_codes(vectors)
+        # per band, row ids sorted by code so a bucket is a contiguous run
+        self.order = np.argsort(codes, axis=0, kind='stable')
+        self.sorted_codes = np.take_along_axis(codes, self.order, axis=0)
+
+    def __len__(self):
+        return 0 if self.vectors is None else len(self.vectors)
+
+    def get_bucket(self, band, code):
+        column = self.sorted_codes[:, band]
+        start = np.searchsorted(column, code, side='left')
+        end = np.searchsorted(column, code, side='right')
+        return self.order[start:end, band]
+
+    def get_candidates(self, vector):
+        codes = self.get_codes(self.normalize([vector]))[0]
+        buckets = [self.get_bucket(band, codes[band])
+                for band in range(self.bands)]
+        return np.unique(np.concatenate(buckets))
+
+    # returns up to k (distance, row) pairs, nearest first, where distance
+    # is 1 - correlation (or cosine) like clusters.pearson
+    def query(self, vector, k=10, exclude=None):
+        candidates = self.get_candidates(vector)
+        if exclude is not None:
+            candidates = candidates[candidates != exclude]
+        if 0 == len(candidates):
+            return []
+        distances = 1.0 - self.vectors[candidates] @ \
+                self.normalize(vector).astype(np.float32)
+        if k < len(candidates):
+            best = np.argpartition(distances, k)[:k]
+        else:
+            best = np.arange(len(candidates))
+        best = best[np.argsort(distances[best], kind='stable')]
+        return [(float(distances[i]), int(candidates[i])) for i in best]
+
+    def similar(self, row, k=10):
+        return self.query(self.vectors[row], k, exclude=row)
+
+    # all (i, j) pairs with i < j that share a bucket in some band; buckets
+    # larger than max_bucket are ignored since they carry little signal
+    def candidate_pairs(self, max_bucket=100):
+        pairs = []
+        for band in range(self.bands):
+            column = self.sorted_codes[:, band]
+            starts = np.flatnonzero(np.concatenate(([True],
+                column[1:] != column[:-1])))
+            ends = np.append(starts[1:], len(column))
+            for start, end in zip(starts, ends):
+                if end - start < 2 or max_bucket < end - start:
+                    continue
+                members = np.sort(self.order[start:end, band])
+                i, j = np.triu_indices(len(members), 1)
+                pairs.append(np.stack((members[i], members[j]), axis=1))
+        if not pairs:
+            return np.empty((0, 2), dtype=np.int64)
+        return np.unique(np.concatenate(pairs), axis=0)
+
+    def save(self, filename):
+        with open(filename, 'wb') as out:
+            np.savez(out, planes=self.planes, vectors=self.vectors,
+                    order=self.order, sorted_codes=self.sorted_codes,
+                    settings=np.array([self.bands, self.rows_per_band]),
+                    metric=np.array(self.metric))
+
+def load_index(filename):
+    with np.load(filename) as data:
+        bands, rows_per_band = data['settings'].tolist()
+        index = LSHIndex(bands=bands, rows_per_band=rows_per_band,
+                metric=str(data['metric']))
+        index.planes = data['planes']
+        index.vectors = data['vectors']
+        index.order = data['order']
+        index.sorted_codes = data['sorted_codes']
+    return index
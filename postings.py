@@ -0,0 +1,117 @@
+import itertools
+
+# one row per word and page instead of word_location's one row per
+# occurrence. the positions are sorted, stored as the gaps between them,
+# and each gap is a little-endian base-128 varint, so most take one byte.
+# the primary key is the clustered index of a WITHOUT ROWID table, so a
+# term lookup reads one contiguous range and needs no other index.
+MIGRATE_BATCH = 10000
+
+def create_postings_table(con):
+    con.execute('''CREATE TABLE IF NOT EXISTS postings(
+        word_id INTEGER NOT NULL, url_id INTEGER NOT NULL,
+        positions BLOB NOT NULL,
+        PRIMARY KEY(word_id, url_id)) WITHOUT ROWID''')
+
+def has_postings_table(con):
+    return con.execute('SELECT 1 FROM sqlite_master WHERE type = ? AND '
+            'name = ?', ('table', 'postings')).fetchone() is not None
+
+def encode_positions(positions):
+    result = bytearray()
+    last = 0
+    for position in sorted(positions):
+        gap = position - last
+        last = position
+        while 0x80 <= gap:
+            result.append(gap & 0x7f | 0x80)
+            gap >>= 7
+        result.append(gap)
+    return bytes(result)
+
+def decode_positions(blob):
+    positions = []
+    position = 0
+    gap = 0
+    shift = 0
+    for byte in blob:
+        gap |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        position += gap
+        positions.append(position)
+        gap = 0
+        shift = 0
+    return positions
+
+# (word_id, url_id, blob) rows from (word_id, url_id, location) rows that
+# are sorted by word and url
+def group_postings(rows):
+    for (word_id, url_id), group in itertools.groupby(rows,
+            key=lambda row: (row[0], row[1])):
+        yield word_id, url_id, encode_positions(row[2] for row in group)
+
+# copies word_location into postings; with drop, word_location and its
+# index are dropped afterwards (run VACUUM to give the space back)
+def migrate(con, drop=False, batch=MIGRATE_BATCH):
+    create_postings_table(con)
+    rows = con.execute('SELECT word_id, url_id, location FROM word_location '
+            'ORDER BY word_id, url_id, location')
+    grouped = group_postings(rows)
+    while True:
+        chunk = list(itertools.islice(grouped, batch))
+        if not chunk:
+            break
+        con.executemany('INSERT OR REPLACE INTO postings(word_id, url_id, '
+                'positions) VALUES (?, ?, ?)', chunk)
+    if drop:
+        con.execute('DROP INDEX IF EXISTS location_index')
+        con.execute('DROP TABLE word_location')
+    con.commit()
+
+class PostingsReader:
+
+    def __init__(self, database):
+        self.con = database
+
+    def get_positions(self, word_id, url_id):
+        row = self.con.execute('SELECT positions FROM postings WHERE '
+                'word_id = ? AND url_id = ?', (word_id, url_id)).fetchone()
+        return decode_positions(row[0]) if row else []
+
+    # url_id -> positions of every page with the word
+    def get_postings(self, word_id):
+        return dict((url_id, decode_positions(blob)) for url_id, blob in
+                self.con.execute('SELECT url_id, positions FROM postings '
+                    'WHERE word_id = ?', (word_id,)))
+
+    def get_url_ids(self, word_id):
+        return set(row[0] for row in self.con.execute(
+            'SELECT url_id FROM postings WHERE word_id = ?', (word_id,)))
+
+    # the rows of Searcher's word_location self-join: (url_id, location of
+    # the first word, location of the second, ...) for every combination
+    # of locations in the pages that have all the words
+    def find_matches(self, word_ids):
+        if not word_ids:
+            return []
+        url_ids = None
+        for word_id in word_ids:
+            found = self.get_url_ids(word_id)
+            url_ids = found if url_ids is None else url_ids & found
+            if not url_ids:
+                return []
+        postings = {}
+        for word_id in set(word_ids):
+            postings[word_id] = dict((url_id, decode_positions(blob))
+                    for url_id, blob in self.con.execute(
+                        'SELECT url_id, positions FROM postings WHERE '
+                        'word_id = ? AND url_id IN (%s)' % ','.join(
+                            str(url_id) for url_id in url_ids), (word_id,)))
+        rows = []
+        for url_id in sorted(url_ids):
+            for locations in itertools.product(*[postings[word_id][url_id]
+                    for word_id in word_ids]):
+                rows.append((url_id,) + locations)
+        return rows
@@ -0,0 +1,103 @@
+from concurrent.futures import ProcessPoolExecutor
+import decisiontree
+import math
+import os
+import random
+
+# rows shared by the trees trained in one pool worker
+worker_rows = []
+
+def set_worker_rows(rows):
+    worker_rows[:] = rows
+
+def train_tree(task):
+    seed, score, bins, subsets, max_features, max_gain, bootstrap = task
+    generator = random.Random(seed)
+    rows = worker_rows
+    if bootstrap:
+        rows = generator.choices(rows, k=len(rows))
+    tree = decisiontree.build_tree(rows, score, bins, subsets, max_features,
+            generator.random())
+    if max_gain is not None:
+        decisiontree.prune(tree, max_gain, score)
+    return decisiontree.compile_tree(tree)
+
+def get_max_features(max_features, attribute_num):
+    if 'sqrt' == max_features:
+        return max(1, int(math.sqrt(attribute_num)))
+    if 'log2' == max_features:
+        return max(1, int(math.log2(attribute_num)))
+    return max_features
+
+# bagged decision trees that each see a bootstrap sample of the rows and a
+# random subset of max_features attributes at every split; predictions are
+# the averaged class probabilities of the trees' leaves
+class RandomForest:
+    def __init__(self, tree_num=10, score=decisiontree.entropy,
+            max_features='sqrt', bootstrap=True, max_gain=None, bins=None,
+            subsets=False, seed=None, workers=None):
+        self.tree_num = tree_num
+        self.score = score
+        self.max_features = max_features
+        self.bootstrap = bootstrap
+        self.max_gain = max_gain
+        self.bins = bins
+        self.subsets = subsets
+        self.seed = seed
+        self.workers = workers
+        self.trees = []
+        self.classes = []
+        # per tree, the class probabilities of each leaf aligned to classes
+        self.leaf_probabilities = []
+
+    def fit(self, rows):
+        if 0 == len(rows):
+            raise ValueError('no rows to train on')
+        generator = random.Random(self.seed)
+        max_features = get_max_features(self.max_features,
+                len(rows[0].attributes))
+        tasks = [(generator.random(), self.score, self.bins, self.subsets,
+            max_features, self.max_gain, self.bootstrap)
+            for i in range(self.tree_num)]
+        workers = self.workers or os.cpu_count() or 1
+        if 1 == workers:
+            set_worker_rows(rows)
+            self.trees = [train_tree(task) for task in tasks]
+            set_worker_rows([])
+        else:
+            with ProcessPoolExecutor(max_workers=workers,
+                    initializer=set_worker_rows,
+                    initargs=(rows,)) as pool:
+                self.trees = list(pool.map(train_tree, tasks))
+        self.classes = sorted(set(row.result for row in rows), key=str)
+        self.leaf_probabilities = [self.get_leaf_probabilities(tree)
+                for tree in self.trees]
+        return self
+
+    def get_leaf_probabilities(self, tree):
+        result = []
+        for leaf in range(tree.leaf_num()):
+            distribution = tree.get_distribution(leaf)
+            total = sum(distribution.values())
+            result.append([distribution.get(c, 0) / total if total else 0.0
+                for c in self.classes])
+        return result
+
+    def classify_batch(self, observations):
+        totals = [[0.0] * len(self.classes) for observation in observations]
+        for tree, probabilities in zip(self.trees, self.leaf_probabilities):
+            for total, observation in zip(totals, observations):
+                leaf = probabilities[tree.leaves[tree.get_leaf(observation)]]
+                for c in range(len(total)):
+                    total[c] += leaf[c]
+        return [dict((result, value / len(self.trees))
+            for result, value in zip(self.classes, total) if value)
+            for total in totals]
+
+    def classify(self, observation):
+        return self.classify_batch([observation])[0]
+
+if __name__ == '__main__':
+    rows = decisiontree.get_rows(decisiontree.my_data)
+    forest = RandomForest(tree_num=20, seed=0).fit(rows)
+    print(forest.classify(['google', 'USA', 'yes', 30]))
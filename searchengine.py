@@ -1,180 +1,429 @@
-from html.parser import HTMLParser
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import hashlib
+import math
+import postings
 import re
 import requests
 import sqlite3
+import threading
+import time
+import tokenizer
 import urllib
 
+TIMEOUT = 10
+MAX_WORKERS = 8
+MAX_PER_HOST = 2
+RETRIES = 2
+BACKOFF = 0.5
+# buffered rows written per flush, pages indexed per transaction, and the
+# page cache size in KiB for bulk loading
+FLUSH_ROWS = 20000
+COMMIT_PAGES = 50
+BULK_CACHE_SIZE = 64 * 1024
+# host parameters per IN (...) query, below SQLite's oldest limit
+SQL_BATCH = 500
+# whole script and style elements, which hold no text
+SKIPPED_BLOCKS = re.compile(r'<(script|style)\b.*?</\1\s*>',
+        re.DOTALL | re.IGNORECASE)
+
+# trades durability of the last transactions for write speed: the write
+# ahead log lets a crawl append without rewriting pages, and NORMAL sync
+# only waits for the disk at checkpoints
+def configure_bulk_load(con, cache_size=BULK_CACHE_SIZE):
+    con.execute('PRAGMA journal_mode=WAL')
+    con.execute('PRAGMA synchronous=NORMAL')
+    con.execute('PRAGMA cache_size=%d' % -cache_size)
+
 class Link:
     def __init__(self, href, text):
         self.href = href
         self.text = text
 
-class HTMLLinkParser(HTMLParser):
+# collects in one pass what indexing a page needs: the visible text as a
+# list of chunks, its words with their positions (see tokenizer.Tokenizer)
+# and the links with all the text inside each anchor
+class HTMLExtractor(tokenizer.Tokenizer):
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, stop_words=()):
+        super().__init__(stop_words, positions=True)
+        self.texts = []
         self.links = []
-        self.last_tag = None
-        self.last_href = None
-        self.last_data = None
+        # href and text chunks of the open anchor
+        self.anchor = None
 
-    def get_links(self):
-        return self.links
-
-    def handle_starttag(self, tag, attributes):
-        self.last_href = None
-        self.last_tag = tag
-        if 'a' != tag:
-            return
-        for (key, value) in attributes:
-            if 'href' == key:
-                self.last_href = value
-
-    def handle_endtag(self, tag):
-        if self.last_tag != 'a':
-            return
-        self.links.append(Link(self.last_href, self.last_data))
-
-    def handle_data(self, data):
-        self.last_data = data
-
-class HTMLTextParser(HTMLParser):
+    def reset(self):
+        super().reset()
+        self.texts = []
+        self.links = []
+        self.anchor = None
 
-    def __init__(self):
-        super().__init__()
-        self.text = ''
-        self.tags = []
+    def close(self):
+        super().close()
+        self.close_anchor()
 
     def get_text(self):
-        return self.text
+        return ''.join(self.texts)
 
-    def get_tag(self):
-        if not self.tags:
-            return None
-        return self.tags[-1]
+    def get_links(self):
+        return self.links
 
-    def should_ignore(self, tag):
-        return tag in ['script']
+    def close_anchor(self):
+        if self.anchor is None:
+            return
+        href, texts = self.anchor
+        self.links.append(Link(href, ''.join(texts)))
+        self.anchor = None
 
     def handle_starttag(self, tag, attributes):
-        self.tags.append(tag.lower())
+        super().handle_starttag(tag, attributes)
+        if 'a' != tag:
+            return
+        # anchors do not nest, a new one ends the last
+        self.close_anchor()
+        href = dict(attributes).get('href')
+        if href is not None:
+            self.anchor = (href, [])
 
     def handle_endtag(self, tag):
-        if (tag == self.get_tag()):
-            self.tags.pop()
-        self.text += '\n'
+        super().handle_endtag(tag)
+        if 'a' == tag:
+            self.close_anchor()
 
     def handle_data(self, data):
-        if self.should_ignore(self.get_tag()): return
-        self.text += data
-
+        super().handle_data(data)
+        if self.skipping:
+            return
+        self.texts.append(data)
+        if self.anchor is not None:
+            self.anchor[1].append(data)
+
+# with fast, script and style elements are cut out with one regular
+# expression before parsing, so the parser never scans their content
+def extract_page(html, stop_words=(), fast=True):
+    if fast:
+        html = SKIPPED_BLOCKS.sub(' ', html)
+    extractor = HTMLExtractor(stop_words)
+    extractor.feed(html)
+    extractor.close()
+    return extractor
+
+# fetches pages on a thread pool with at most max_workers requests in
+# flight and at most max_per_host to any one host. every worker keeps its
+# own session, so connections to a host are kept alive and reused.
+class PageFetcher:
+
+    def __init__(self, max_workers=MAX_WORKERS, max_per_host=MAX_PER_HOST,
+            timeout=TIMEOUT, retries=RETRIES, backoff=BACKOFF):
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.local = threading.local()
+
+    def get_session(self):
+        if not hasattr(self.local, 'session'):
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                    pool_maxsize=self.max_per_host)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self.local.session = session
+        return self.local.session
+
+    # the text of the page, or None once the retries are used up or for a
+    # url that cannot be requested; errors that a retry cannot fix are not
+    # retried
+    def fetch(self, url):
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                response = self.get_session().get(url, timeout=self.timeout)
+            except ValueError:
+                # a malformed url, like an empty host label; requests'
+                # InvalidURL and MissingSchema are ValueErrors too
+                return None
+            except requests.RequestException:
+                continue
+            if 500 <= response.status_code or 429 == response.status_code:
+                continue
+            if 400 <= response.status_code:
+                return None
+            return response.text
+        return None
+
+    # yields (url, text) pairs as the pages arrive; text is None for pages
+    # that could not be fetched
+    def fetch_all(self, urls):
+        pending = {}
+        for url in urls:
+            host = urllib.parse.urlparse(url).netloc
+            pending.setdefault(host, deque()).append(url)
+        active = dict((host, 0) for host in pending)
+        # hosts with pages waiting and a free slot
+        ready = deque(pending)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while ready or running:
+                while ready and len(running) < self.max_workers:
+                    host = ready.popleft()
+                    url = pending[host].popleft()
+                    active[host] += 1
+                    running[pool.submit(self.fetch, url)] = (url, host)
+                    if pending[host] and active[host] < self.max_per_host:
+                        ready.append(host)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    url, host = running.pop(future)
+                    active[host] -= 1
+                    if pending[host] and host not in ready:
+                        ready.append(host)
+                    yield url, future.result()
+
+# a set that can answer wrongly that it holds a key, with probability
+# error_rate once capacity keys are in it, in about 1.8 bytes per key for
+# 0.1% (-ln(0.001) / ln(2)^2 = 14.4 bits); it never misses a key it holds
+class BloomFilter:
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.bit_num = max(8, math.ceil(-capacity * math.log(error_rate) /
+            math.log(2) ** 2))
+        self.hash_num = max(1, round(self.bit_num / capacity * math.log(2)))
+        self.bits = bytearray((self.bit_num + 7) // 8)
+
+    # double hashing: the positions are h1 + i * h2 for i below hash_num
+    def get_positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bit_num for i in range(self.hash_num)]
+
+    def add(self, key):
+        for position in self.get_positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                for position in self.get_positions(key))
+
+# words, locations, links and link words are buffered in memory and
+# written with executemany once flush_rows rows are waiting; the
+# transaction is committed every commit_pages pages. word, url and link ids
+# are allocated here rather than by SQLite, so a crawler must be the only
+# writer of its database. the url ids and the set of indexed urls are read
+# once and then kept in memory, so checking a link takes no queries. pages
+# fetched by this crawler are not fetched again; with bloom_capacity they
+# are remembered in a Bloom filter instead of a set, which takes much less
+# memory for large crawls but skips a few pages that were never fetched.
+# like Searcher, the crawler writes the locations to the postings table
+# (see postings) when the database has one and to word_location otherwise;
+# create_index_tables(use_postings=True) starts a database with postings.
 class Crawler:
 
-    def __init__(self, database, ignored_words=[]):
+    def __init__(self, database, ignored_words=(), flush_rows=FLUSH_ROWS,
+            commit_pages=COMMIT_PAGES, bulk_load=False, bloom_capacity=None):
         self.con = database
-        self.ignored_words = ignored_words
-
-    def crawl(self, pages, depth):
-        for i in range(depth):
-            new_pages = set()
-            for page in pages:
-                try:
-                    response = requests.get(page)
-                except:
-                    print('failed to read ' + page)
-                    continue
-
-                parser = HTMLLinkParser()
-                parser.feed(response.text)
-                links = parser.get_links()
-
-                for link in links:
-                    # the href might be relative to the current page
-                    url = urllib.parse.urljoin(page, link.href)
-                    url_parts = urllib.parse.urlparse(url)
-                    # todo?
-                    normalized_url = url
-                    if 'http' in url_parts.scheme and \
-                            not self.is_indexed(normalized_url):
-                        new_pages.add(url)
-
-                    if not self.is_indexed(page):
-                        self.add_link_ref(page, normalized_url, link.text)
-
-                self.add_to_index(page, response.text, self.ignored_words)
-                self.commit()
-
-            pages = new_pages
+        self.use_postings = postings.has_postings_table(self.con)
+        self.ignored_words = frozenset(ignored_words)
+        self.flush_rows = flush_rows
+        self.commit_pages = commit_pages
+        if bulk_load:
+            configure_bulk_load(self.con)
+        self.word_ids = {}
+        self.next_ids = {}
+        self.urls = []
+        self.locations = []
+        self.posting_rows = []
+        self.links = []
+        self.link_words = []
+        self.uncommitted_pages = 0
+        # loaded on first use: url -> rowid and the ids of indexed urls
+        self.url_ids = None
+        self.indexed = None
+        self.visited = BloomFilter(bloom_capacity) if bloom_capacity \
+                else set()
+
+    # breadth first: the pages found at one depth are fetched, all of them
+    # concurrently, before any page they link to. the pages are indexed
+    # on this thread as they arrive. the pages indexed so far are committed
+    # even when the crawl ends with an error or is interrupted.
+    def crawl(self, pages, depth, fetcher=None):
+        fetcher = fetcher or PageFetcher()
+        try:
+            for i in range(depth):
+                new_pages = set()
+                # marked before fetching, so links to pages of this level
+                # that have not arrived yet do not queue them again
+                for page in pages:
+                    self.visited.add(page)
+                for page, text in fetcher.fetch_all(pages):
+                    if text is None:
+                        print('failed to read ' + page)
+                        continue
+                    new_pages.update(self.index_page(page, text))
+                pages = new_pages
+        finally:
+            self.commit()
+
+    # indexes a fetched page and its links; returns the pages it links to
+    # that are not indexed yet
+    def index_page(self, page, text):
+        new_pages = set()
+        extractor = extract_page(text, self.ignored_words)
+        page_indexed = self.is_indexed(page)
+
+        for link in extractor.get_links():
+            # the href might be relative to the current page
+            url = urllib.parse.urljoin(page, link.href)
+            url_parts = urllib.parse.urlparse(url)
+            # todo?
+            normalized_url = url
+            if 'http' in url_parts.scheme and \
+                    not self.is_indexed(normalized_url) and \
+                    normalized_url not in self.visited:
+                new_pages.add(url)
+
+            if not page_indexed:
+                self.add_link_ref(page, normalized_url, link.text)
+
+        self.add_words(page, extractor.tokens)
+        self.uncommitted_pages += 1
+        if self.commit_pages <= self.uncommitted_pages:
+            self.commit()
+        return new_pages
 
     def get_text_only(self, html):
         return html
 
     def separate_words(self, text):
-        pattern = re.compile('[\W_]')
-        words = [pattern.sub('', s).lower() for s in text.split()]
-        return [s for s in words if s]
+        return tokenizer.tokenize(text or '', markup=False)
 
     def commit(self):
+        self.flush()
         self.con.commit()
+        self.uncommitted_pages = 0
+
+    def flush(self):
+        self.con.executemany('INSERT INTO url(rowid, url) VALUES (?, ?)',
+                self.urls)
+        self.con.executemany('INSERT INTO link(rowid, from_id, to_id) '
+                'VALUES (?, ?, ?)', self.links)
+        if self.locations:
+            self.con.executemany('INSERT INTO word_location(url_id, word_id, '
+                    'location) VALUES (?, ?, ?)', self.locations)
+        if self.posting_rows:
+            self.con.executemany('INSERT INTO postings(word_id, url_id, '
+                    'positions) VALUES (?, ?, ?)', self.posting_rows)
+        self.con.executemany('INSERT INTO link_words(word_id, link_id) '
+                'VALUES (?, ?)', self.link_words)
+        self.urls = []
+        self.links = []
+        self.locations = []
+        self.posting_rows = []
+        self.link_words = []
 
-    def get_entry_id(self, table, column, value):
-        # this is an insecure hack
-        cursor = self.con.execute(
-                'SELECT rowid FROM {} WHERE {} = ?'.format(table, column),
-                    (value,))
-        result = cursor.fetchone()
-        if result is not None:
-            return result[0]
-        cursor = self.con.execute(
-                'INSERT INTO {}({}) VALUES (?)'.format(table, column),
-                (value,))
-        return cursor.lastrowid
+    def get_pending_rows(self):
+        return len(self.urls) + len(self.locations) + \
+                len(self.posting_rows) + len(self.links) + \
+                len(self.link_words)
 
+    def load_urls(self):
+        if self.url_ids is not None:
+            return
+        self.url_ids = dict((url, rowid) for rowid, url in
+                self.con.execute('SELECT rowid, url FROM url'))
+        self.indexed = set(row[0] for row in self.con.execute(
+            'SELECT DISTINCT url_id FROM {}'.format('postings'
+                if self.use_postings else 'word_location')))
+
+    def get_url_id(self, url):
+        self.load_urls()
+        url_id = self.url_ids.get(url)
+        if url_id is None:
+            url_id = self.allocate_ids('url', 1)
+            self.url_ids[url] = url_id
+            self.urls.append((url_id, url))
+        return url_id
+
+    def flush_if_full(self):
+        if self.flush_rows <= self.get_pending_rows():
+            self.flush()
+
+    # the first of count new rowids of table
+    def allocate_ids(self, table, count):
+        if table not in self.next_ids:
+            last = self.con.execute(
+                    'SELECT MAX(rowid) FROM {}'.format(table)).fetchone()[0]
+            self.next_ids[table] = (last or 0) + 1
+        first = self.next_ids[table]
+        self.next_ids[table] += count
+        return first
+
+    # word -> rowid for all of words, looking up the ones that are not
+    # cached yet in batches and inserting the ones that are new together
+    def get_word_ids(self, words):
+        missing = [word for word in dict.fromkeys(words)
+                if word not in self.word_ids]
+        for start in range(0, len(missing), SQL_BATCH):
+            batch = missing[start:start + SQL_BATCH]
+            self.word_ids.update((word, rowid) for rowid, word in
+                    self.con.execute('SELECT rowid, word FROM word WHERE '
+                        'word IN (%s)' % ','.join('?' * len(batch)), batch))
+        new_words = [word for word in missing if word not in self.word_ids]
+        if new_words:
+            first = self.allocate_ids('word', len(new_words))
+            rows = list(zip(range(first, first + len(new_words)), new_words))
+            self.con.executemany('INSERT INTO word(rowid, word) VALUES (?, ?)',
+                    rows)
+            self.word_ids.update((word, rowid) for rowid, word in rows)
+        return self.word_ids
 
     def add_to_index(self, url, content, ignored_words):
         if self.is_indexed(url):
             return
-        print('indexing ' + url)
-        parser = HTMLTextParser()
-        parser.feed(content)
-        text = parser.get_text()
-        words = self.separate_words(text)
+        # ignored words still count towards the locations of the others
+        self.add_words(url, tokenizer.tokenize(content, ignored_words,
+            positions=True))
 
-        url_id = self.get_entry_id('url', 'url', url)
-
-        for i in range(len(words)):
-            word = words[i]
-            if word in ignored_words:
-                continue
-            word_id = self.get_entry_id('word', 'word', word)
-            self.con.execute('''INSERT INTO word_location(url_id,
-                word_id, location) VALUES (?, ?, ?)''', (url_id, word_id, i))
+    # words are (word, location) pairs
+    def add_words(self, url, words):
+        if self.is_indexed(url):
+            return
+        print('indexing ' + url)
+        url_id = self.get_url_id(url)
+
+        word_ids = self.get_word_ids(word for word, i in words)
+        if self.use_postings:
+            locations = {}
+            for word, i in words:
+                locations.setdefault(word_ids[word], []).append(i)
+            self.posting_rows.extend((word_id, url_id,
+                postings.encode_positions(word_locations))
+                for word_id, word_locations in locations.items())
+        else:
+            self.locations.extend((url_id, word_ids[word], i)
+                    for word, i in words)
+        if words:
+            self.indexed.add(url_id)
+        self.flush_if_full()
 
     def add_link_ref(self, page, url, linktext):
-        from_id = self.get_entry_id('url', 'url', page)
-        to_id = self.get_entry_id('url', 'url', url)
-        cursor = self.con.execute(
-                'INSERT INTO link(from_id, to_id) VALUES (?,?)',
-                (from_id, to_id))
-        link_id = cursor.lastrowid
+        from_id = self.get_url_id(page)
+        to_id = self.get_url_id(url)
+        link_id = self.allocate_ids('link', 1)
+        self.links.append((link_id, from_id, to_id))
         words = self.separate_words(linktext)
-        for word in words:
-            word_id = self.get_entry_id('word', 'word', word)
-            self.con.execute(
-            'INSERT INTO link_words(word_id, link_id) VALUES (?,?)',
-            (word_id, link_id))
+        word_ids = self.get_word_ids(words)
+        self.link_words.extend((word_ids[word], link_id) for word in words)
+        self.flush_if_full()
 
     def is_indexed(self, url):
-        indexed_url = self.con.execute(
-                'SELECT rowid FROM url WHERE url = ?', (url,)).fetchone()
-        if not indexed_url:
-            return False
-        indexed_word = self.con.execute(
-                'SELECT * FROM word_location WHERE url_id = ?',
-                (indexed_url[0],)).fetchone()
-        return bool(indexed_word)
-
-    def create_index_tables(self):
+        self.load_urls()
+        return self.url_ids.get(url) in self.indexed
+
+    def create_index_tables(self, use_postings=False):
         self.con.execute('CREATE TABLE url(url)')
         self.con.execute('CREATE TABLE word(word)')
         self.con.execute(
@@ -187,13 +436,16 @@ class Crawler:
                 'CREATE INDEX location_index ON word_location(word_id)')
         self.con.execute('CREATE INDEX url_from_index ON link(from_id)')
         self.con.execute('CREATE INDEX url_to_index ON link(to_id)')
+        if use_postings:
+            postings.create_postings_table(self.con)
         self.con.commit()
+        self.use_postings = postings.has_postings_table(self.con)
 
 if __name__ == '__main__':
     url = 'https://kiwitobes.com'
     dbname = 'searchengine.sqlite3'
     con = sqlite3.connect(dbname)
-    crawler = Crawler(con)
+    crawler = Crawler(con, bulk_load=True)
     crawler.crawl([url], 2)
     del crawler
     con.close()
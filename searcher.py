@@ -1,5 +1,6 @@
 from collections import namedtuple
 import neuralnetwork
+import postings
 import sqlite3
 import sys
 
@@ -7,8 +8,12 @@ Match = namedtuple('Match', ['url_id', 'locations'])
 
 class Searcher:
 
+    # the locations are read from the postings table when the database has
+    # one, and from word_location otherwise
     def __init__(self, database):
         self.con = database
+        self.postings = postings.PostingsReader(database) \
+                if postings.has_postings_table(database) else None
 
     def find_matches(self, search_term):
         fields = ['w0.url_id']
@@ -38,6 +43,10 @@ class Searcher:
         if not word_ids:
             return [], []
 
+        if self.postings is not None:
+            return [Match(row[0], row[1:])
+                for row in self.postings.find_matches(word_ids)], word_ids
+
         sql_query = 'SELECT %s FROM %s WHERE %s' % (
                 ', '.join(fields),
                 ', '.join(tables),
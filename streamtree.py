@@ -0,0 +1,298 @@
+from array import array
+from bisect import bisect_left
+import csv
+import decisiontree
+import random
+
+MAX_BINS = 32
+MAX_CATEGORIES = 256
+SAMPLE_SIZE = 10000
+
+# yields lists of rows, each a list of attribute values followed by the
+# result; columns listed in numeric are converted to int
+def read_chunks(filename, chunk_size=10000, header=True, numeric=()):
+    with open(filename, 'r', newline='') as fin:
+        reader = csv.reader(fin)
+        if header:
+            next(reader, None)
+        chunk = []
+        for row in reader:
+            if not row:
+                continue
+            for i in numeric:
+                row[i] = int(row[i])
+            chunk.append(row)
+            if chunk_size <= len(chunk):
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+def read_header(filename):
+    with open(filename, 'r', newline='') as fin:
+        return next(csv.reader(fin), [])[:-1]
+
+def is_int(value):
+    try:
+        int(value)
+        return True
+    except ValueError:
+        return False
+
+# approximate counts of the most frequent values in bounded memory
+# (Misra-Gries); values that are dropped can only be rare ones
+class FrequentValues:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+
+    def add(self, value):
+        if value in self.counts:
+            self.counts[value] += 1
+        elif len(self.counts) < self.capacity:
+            self.counts[value] = 1
+        else:
+            for key in list(self.counts):
+                self.counts[key] -= 1
+                if 0 == self.counts[key]:
+                    del self.counts[key]
+
+    def most_common(self, n):
+        return sorted(self.counts, key=self.counts.get, reverse=True)[:n]
+
+# per column, sorted numeric thresholds or the category codes, learned in
+# one pass; every other value of a categorical column shares the last bin
+class Schema:
+    def __init__(self, numeric, edges, categories, classes):
+        self.numeric = numeric
+        self.edges = edges
+        self.categories = categories
+        self.codes = [dict((value, code) for code, value in enumerate(values))
+                for values in categories]
+        self.classes = classes
+        self.class_ids = dict((result, i) for i, result in enumerate(classes))
+
+    def get_bin_num(self, attribute_id):
+        if self.numeric[attribute_id]:
+            return len(self.edges[attribute_id]) + 1
+        return len(self.categories[attribute_id]) + 1
+
+    def get_bin(self, attribute_id, value):
+        if self.numeric[attribute_id]:
+            return bisect_left(self.edges[attribute_id], value)
+        codes = self.codes[attribute_id]
+        return codes.get(value, len(codes))
+
+def learn_schema(filename, header=True, max_bins=MAX_BINS,
+        max_categories=MAX_CATEGORIES, sample_size=SAMPLE_SIZE, seed=None):
+    generator = random.Random(seed)
+    numeric = None
+    samples = []
+    frequent = []
+    classes = set()
+    seen = 0
+    for chunk in read_chunks(filename, header=header):
+        for row in chunk:
+            attributes = row[:-1]
+            if numeric is None:
+                numeric = [True] * len(attributes)
+                samples = [[] for value in attributes]
+                frequent = [FrequentValues(10 * max_categories)
+                        for value in attributes]
+            classes.add(row[-1])
+            seen += 1
+            for i, value in enumerate(attributes):
+                frequent[i].add(value)
+                if numeric[i] and not is_int(value):
+                    numeric[i] = False
+                if not numeric[i]:
+                    continue
+                # reservoir sample for the quantile thresholds
+                if len(samples[i]) < sample_size:
+                    samples[i].append(int(value))
+                else:
+                    slot = generator.randrange(seen)
+                    if slot < sample_size:
+                        samples[i][slot] = int(value)
+    if numeric is None:
+        raise ValueError(filename + ' has no rows')
+
+    edges = []
+    categories = []
+    for i in range(len(numeric)):
+        if numeric[i]:
+            values = sorted(samples[i])
+            thresholds = sorted(set(values[len(values) * k // max_bins]
+                for k in range(1, max_bins)))
+            edges.append(thresholds)
+            categories.append([])
+        else:
+            edges.append([])
+            categories.append(frequent[i].most_common(max_categories))
+    return Schema(numeric, edges, categories, sorted(classes, key=str))
+
+def get_totals(histogram, class_num):
+    totals = [0] * class_num
+    for counts in histogram[0]:
+        for c in range(class_num):
+            totals[c] += counts[c]
+    return totals
+
+def get_gain(score, current_score, left, totals, total):
+    right = [t - l for t, l in zip(totals, left)]
+    left_total = sum(left)
+    if 0 == left_total or left_total == total:
+        return None
+    return decisiontree.get_information_gain(current_score, score, left,
+            right, total)
+
+# best split of one node from its histograms, as (gain, attribute, kind,
+# value) where value is a threshold, a category or a list of categories
+def find_histogram_split(schema, histogram, score, subsets=False):
+    class_num = len(schema.classes)
+    totals = get_totals(histogram, class_num)
+    total = sum(totals)
+    current_score = score(totals, total)
+    best = (0.0, None, None, None)
+    for attribute_id, bins in enumerate(histogram):
+        if schema.numeric[attribute_id]:
+            left = [0] * class_num
+            for k, threshold in enumerate(schema.edges[attribute_id]):
+                left = [l + b for l, b in zip(left, bins[k])]
+                gain = get_gain(score, current_score, left, totals, total)
+                if gain is not None and best[0] <= gain:
+                    best = (gain, attribute_id, decisiontree.NUMERIC,
+                            threshold)
+            continue
+        values = schema.categories[attribute_id]
+        for code, value in enumerate(values):
+            gain = get_gain(score, current_score, bins[code], totals, total)
+            if gain is not None and best[0] <= gain:
+                best = (gain, attribute_id, decisiontree.CATEGORY, value)
+        if not subsets or len(values) < 3:
+            continue
+        majority = max(range(class_num), key=lambda c: totals[c])
+        ordered = sorted((code for code in range(len(values))
+            if sum(bins[code])), key=lambda code: bins[code][majority] /
+            sum(bins[code]))
+        left = [0] * class_num
+        for position, code in enumerate(ordered[:-1]):
+            left = [l + b for l, b in zip(left, bins[code])]
+            if 0 == position:
+                continue
+            gain = get_gain(score, current_score, left, totals, total)
+            if gain is not None and best[0] <= gain:
+                best = (gain, attribute_id, decisiontree.SUBSET,
+                        [values[c] for c in ordered[:position + 1]])
+    return best
+
+# the tree under construction, in the arrays of a compiled tree; open
+# nodes are leaves that have not been given their counts yet
+class TreeArrays:
+    def __init__(self):
+        self.kinds = array('b')
+        self.attributes = array('i')
+        self.values = array('d')
+        self.categories = array('i')
+        self.match = array('i')
+        self.mismatch = array('i')
+        self.leaves = array('i')
+        self.leaf_counts = []
+        self.strings = {}
+        self.subsets = []
+
+    def add_node(self):
+        self.kinds.append(decisiontree.LEAF)
+        self.attributes.append(-1)
+        self.values.append(0.0)
+        self.categories.append(-1)
+        self.match.append(-1)
+        self.mismatch.append(-1)
+        self.leaves.append(-1)
+        return len(self.kinds) - 1
+
+    def get_code(self, value):
+        return self.strings.setdefault(value, len(self.strings))
+
+    def split(self, node, attribute_id, kind, value):
+        self.kinds[node] = kind
+        self.attributes[node] = attribute_id
+        if decisiontree.NUMERIC == kind:
+            self.values[node] = value
+        elif decisiontree.CATEGORY == kind:
+            self.categories[node] = self.get_code(value)
+        else:
+            self.categories[node] = len(self.subsets)
+            self.subsets.append(frozenset(self.get_code(v) for v in value))
+        self.match[node] = self.add_node()
+        self.mismatch[node] = self.add_node()
+        return self.match[node], self.mismatch[node]
+
+    def close(self, node, totals):
+        self.leaves[node] = len(self.leaf_counts)
+        self.leaf_counts.append(totals)
+
+    def compile(self, classes, headers=None):
+        leaf_starts = array('i', [0])
+        leaf_classes = array('i')
+        counts = array('q')
+        for totals in self.leaf_counts:
+            for c, count in enumerate(totals):
+                if count:
+                    leaf_classes.append(c)
+                    counts.append(count)
+            leaf_starts.append(len(counts))
+        strings = sorted(self.strings, key=self.strings.get)
+        return decisiontree.CompiledTree(self.kinds, self.attributes,
+                self.values, self.categories, self.match, self.mismatch,
+                self.leaves, leaf_starts, leaf_classes, counts, classes,
+                strings, self.subsets, headers)
+
+# trains a tree with one pass over the file per level; memory grows with
+# the open nodes times the bins of every column, not with the rows.
+# returns a decisiontree.CompiledTree.
+def build_tree_streaming(filename, score=decisiontree.entropy, header=True,
+        max_depth=20, min_rows=2, max_bins=MAX_BINS,
+        max_categories=MAX_CATEGORIES, subsets=False, chunk_size=10000,
+        seed=None):
+    count_score = decisiontree.COUNT_SCORES[score]
+    schema = learn_schema(filename, header, max_bins, max_categories,
+            seed=seed)
+    numeric_columns = [i for i, numeric in enumerate(schema.numeric)
+            if numeric]
+    class_num = len(schema.classes)
+    tree = TreeArrays()
+    open_nodes = [tree.add_node()]
+
+    for depth in range(max_depth + 1):
+        if not open_nodes:
+            break
+        # node -> attribute -> bin -> class counts
+        histograms = dict((node, [[[0] * class_num
+            for k in range(schema.get_bin_num(i))]
+            for i in range(len(schema.numeric))]) for node in open_nodes)
+        partial = tree.compile(schema.classes)
+        for chunk in read_chunks(filename, chunk_size, header,
+                numeric_columns):
+            for row in chunk:
+                histogram = histograms.get(partial.get_leaf(row))
+                if histogram is None:
+                    continue
+                c = schema.class_ids[row[-1]]
+                for i, bins in enumerate(histogram):
+                    bins[schema.get_bin(i, row[i])][c] += 1
+
+        next_nodes = []
+        for node in open_nodes:
+            histogram = histograms[node]
+            totals = get_totals(histogram, class_num)
+            gain, attribute_id, kind, value = find_histogram_split(schema,
+                    histogram, count_score, subsets)
+            if depth == max_depth or sum(totals) < min_rows or \
+                    not 0.0 < gain:
+                tree.close(node, totals)
+                continue
+            next_nodes.extend(tree.split(node, attribute_id, kind, value))
+        open_nodes = next_nodes
+    return tree.compile(schema.classes,
+            read_header(filename) if header else None)
@@ -0,0 +1,108 @@
+from html.parser import HTMLParser
+import re
+
+# runs of letters and digits in any script
+WORD_PATTERN = re.compile(r'[^\W_]+')
+# tags whose content is not text
+SKIPPED_TAGS = frozenset(['script', 'style'])
+
+# strips markup and splits the text into lowercase words as the input is
+# fed, without building the text first. positions count every word,
+# including stop words, so they match the words' places in the text.
+class Tokenizer(HTMLParser):
+
+    def __init__(self, stop_words=(), positions=False):
+        super().__init__(convert_charrefs=True)
+        self.stop_words = frozenset(stop_words)
+        self.positions = positions
+        self.skipping = 0
+        self.position = 0
+        self.tokens = []
+        self.pending = ''
+
+    def reset(self):
+        super().reset()
+        self.skipping = 0
+        self.position = 0
+        self.tokens = []
+        self.pending = ''
+
+    def close(self):
+        super().close()
+        self.flush()
+
+    def handle_starttag(self, tag, attributes):
+        self.flush()
+        if tag in SKIPPED_TAGS:
+            self.skipping += 1
+
+    def handle_endtag(self, tag):
+        self.flush()
+        if tag in SKIPPED_TAGS and self.skipping:
+            self.skipping -= 1
+
+    # text can arrive in pieces, so a word at the end is held back until
+    # the next piece or tag shows whether it continues
+    def handle_data(self, data):
+        if self.skipping:
+            return
+        text = self.pending + data
+        self.pending = ''
+        self.add_text(text, final=False)
+
+    def flush(self):
+        text = self.pending
+        self.pending = ''
+        self.add_text(text)
+
+    def add_text(self, text, final=True):
+        for match in WORD_PATTERN.finditer(text):
+            if not final and match.end() == len(text):
+                self.pending = match.group()
+                return
+            word = match.group().lower()
+            position = self.position
+            self.position += 1
+            if word in self.stop_words:
+                continue
+            self.tokens.append((word, position) if self.positions else word)
+
+    # the tokens found since the last call
+    def pop_tokens(self):
+        tokens = self.tokens
+        self.tokens = []
+        return tokens
+
+# words of html, or of plain text when markup is False; with positions the
+# words come as (word, position) pairs
+def tokenize(text, stop_words=(), positions=False, markup=True):
+    tokenizer = Tokenizer(stop_words, positions)
+    if markup:
+        tokenizer.feed(text)
+        tokenizer.close()
+    else:
+        tokenizer.add_text(text)
+    return tokenizer.tokens
+
+# yields the tokens of html arriving in chunks as soon as they are complete
+def iter_tokens(chunks, stop_words=(), positions=False):
+    tokenizer = Tokenizer(stop_words, positions)
+    for chunk in chunks:
+        tokenizer.feed(chunk)
+        yield from tokenizer.pop_tokens()
+    tokenizer.close()
+    yield from tokenizer.pop_tokens()
+
+# the tokens of every text, with one tokenizer reused for all of them
+def tokenize_batch(texts, stop_words=(), positions=False, markup=True):
+    tokenizer = Tokenizer(stop_words, positions)
+    result = []
+    for text in texts:
+        if markup:
+            tokenizer.feed(text)
+            tokenizer.close()
+        else:
+            tokenizer.add_text(text)
+        result.append(tokenizer.pop_tokens())
+        tokenizer.reset()
+    return result
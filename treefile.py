@@ -0,0 +1,102 @@
+from array import array
+import decisiontree
+import json
+import mmap
+import struct
+import sys
+
+# fixed header: magic, version, node, leaf and leaf entry counts, and the
+# offset and length of the JSON string table (classes, category values,
+# subsets and column names). the node and leaf arrays follow the header in
+# the order of ARRAYS, little-endian and each aligned, so a loaded tree can
+# use them straight from the mapped file.
+MAGIC = b'DTREE\0\0\0'
+VERSION = 1
+HEADER = struct.Struct('<8sIIIIQQ')
+HEADER_SIZE = 64
+ALIGNMENT = 8
+
+# (attribute, typecode, length) where length is 'nodes', 'leaves' (plus one
+# for the offsets) or 'entries'
+ARRAYS = [
+        ('kinds', 'b', 'nodes'),
+        ('attributes', 'i', 'nodes'),
+        ('values', 'd', 'nodes'),
+        ('categories', 'i', 'nodes'),
+        ('match', 'i', 'nodes'),
+        ('mismatch', 'i', 'nodes'),
+        ('leaves', 'i', 'nodes'),
+        ('leaf_starts', 'i', 'leaves'),
+        ('leaf_classes', 'i', 'entries'),
+        ('leaf_counts', 'q', 'entries')]
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def is_tree_file(filename):
+    with open(filename, 'rb') as fin:
+        return MAGIC == fin.read(len(MAGIC))
+
+def get_lengths(node_num, leaf_num, entry_num):
+    return {'nodes': node_num, 'leaves': leaf_num + 1, 'entries': entry_num}
+
+def save_tree(compiled, filename, column_names=None):
+    lengths = get_lengths(len(compiled), compiled.leaf_num(),
+            len(compiled.leaf_counts))
+    with open(filename, 'wb') as out:
+        out.write(b'\0' * HEADER_SIZE)
+        for name, typecode, length in ARRAYS:
+            values = array(typecode, getattr(compiled, name))
+            if lengths[length] != len(values):
+                raise ValueError(name + ' has the wrong length')
+            if 'big' == sys.byteorder:
+                values.byteswap()
+            out.write(b'\0' * (align(out.tell()) - out.tell()))
+            out.write(values.tobytes())
+        table = json.dumps({'classes': list(compiled.classes),
+            'strings': list(compiled.strings),
+            'subsets': [sorted(subset) for subset in compiled.subsets],
+            'headers': list(column_names or compiled.headers or
+                decisiontree.headers)}).encode('utf-8')
+        table_offset = align(out.tell())
+        out.write(b'\0' * (table_offset - out.tell()))
+        out.write(table)
+        out.seek(0)
+        out.write(HEADER.pack(MAGIC, VERSION, lengths['nodes'],
+            lengths['leaves'] - 1, lengths['entries'], table_offset,
+            len(table)))
+
+def get_array(buffer, offset, typecode, length):
+    view = memoryview(buffer)[offset:offset + length *
+            array(typecode).itemsize]
+    if 'little' == sys.byteorder:
+        return view.cast(typecode)
+    values = array(typecode, view.tobytes())
+    values.byteswap()
+    return values
+
+# maps the file and returns a decisiontree.CompiledTree whose arrays are
+# views of it; only the string table is parsed
+def load_tree(filename):
+    with open(filename, 'rb') as fin:
+        buffer = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    (magic, version, node_num, leaf_num, entry_num, table_offset,
+            table_length) = HEADER.unpack_from(buffer)
+    if MAGIC != magic:
+        raise ValueError(filename + ' is not a decision tree')
+    if VERSION < version:
+        raise ValueError('unsupported decision tree version ' +
+                str(version))
+    lengths = get_lengths(node_num, leaf_num, entry_num)
+    arrays = {}
+    offset = HEADER_SIZE
+    for name, typecode, length in ARRAYS:
+        offset = align(offset)
+        arrays[name] = get_array(buffer, offset, typecode, lengths[length])
+        offset += len(arrays[name]) * array(typecode).itemsize
+    table = json.loads(
+            buffer[table_offset:table_offset + table_length].decode('utf-8'))
+    return decisiontree.CompiledTree(strings=table['strings'],
+            classes=table['classes'], headers=table['headers'],
+            subsets=[frozenset(subset) for subset in table['subsets']],
+            **arrays)
@@ -0,0 +1,169 @@
+import sqlite3
+
+STORE_FILE = 'wordcount.sqlite3'
+
+# word counts of every feed entry seen so far, keyed by the entry id, with
+# the per-feed totals and the number of feeds each word appeared in kept up
+# to date as entries are added, so a run only does work for new entries
+class WordStore:
+    def __init__(self, filename=STORE_FILE):
+        self.con = sqlite3.connect(filename)
+        self.create_tables()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.con.commit()
+        self.con.close()
+
+    def create_tables(self):
+        self.con.executescript('''
+            CREATE TABLE IF NOT EXISTS feed(id INTEGER PRIMARY KEY,
+                url TEXT UNIQUE, title TEXT);
+            CREATE TABLE IF NOT EXISTS word(id INTEGER PRIMARY KEY,
+                word TEXT UNIQUE);
+            CREATE TABLE IF NOT EXISTS entry(id INTEGER PRIMARY KEY,
+                feed_id INTEGER, entry_key TEXT, UNIQUE(feed_id, entry_key));
+            CREATE TABLE IF NOT EXISTS entry_word(entry_id INTEGER,
+                word_id INTEGER, count INTEGER,
+                PRIMARY KEY(entry_id, word_id)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS feed_word(feed_id INTEGER,
+                word_id INTEGER, count INTEGER,
+                PRIMARY KEY(feed_id, word_id)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS blog_count(word_id INTEGER PRIMARY KEY,
+                count INTEGER);''')
+        self.con.commit()
+
+    def commit(self):
+        self.con.commit()
+
+    def get_feed_id(self, url, title=None):
+        self.con.execute('INSERT OR IGNORE INTO feed(url, title) VALUES (?, ?)',
+                (url, title))
+        if title is not None:
+            self.con.execute('UPDATE feed SET title = ? WHERE url = ?',
+                    (title, url))
+        return self.con.execute('SELECT id FROM feed WHERE url = ?',
+                (url,)).fetchone()[0]
+
+    def get_word_id(self, word):
+        self.con.execute('INSERT OR IGNORE INTO word(word) VALUES (?)',
+                (word,))
+        return self.con.execute('SELECT id FROM word WHERE word = ?',
+                (word,)).fetchone()[0]
+
+    def has_entry(self, feed_id, entry_key):
+        return self.con.execute(
+                'SELECT 1 FROM entry WHERE feed_id = ? AND entry_key = ?',
+                (feed_id, entry_key)).fetchone() is not None
+
+    # records the word counts of one entry; returns False, changing
+    # nothing, when the entry is already in the store
+    def add_entry(self, feed_id, entry_key, word_count):
+        cursor = self.con.execute(
+                'INSERT OR IGNORE INTO entry(feed_id, entry_key) VALUES (?, ?)',
+                (feed_id, entry_key))
+        if 0 == cursor.rowcount:
+            return False
+        entry_id = cursor.lastrowid
+        for word, count in word_count.items():
+            word_id = self.get_word_id(word)
+            self.con.execute('INSERT INTO entry_word(entry_id, word_id, count)'
+                    ' VALUES (?, ?, ?)', (entry_id, word_id, count))
+            # the first time the feed uses a word, one more blog has it
+            if self.con.execute('INSERT OR IGNORE INTO feed_word(feed_id, '
+                    'word_id, count) VALUES (?, ?, 0)',
+                    (feed_id, word_id)).rowcount:
+                self.con.execute('INSERT OR IGNORE INTO blog_count(word_id, '
+                        'count) VALUES (?, 0)', (word_id,))
+                self.con.execute('UPDATE blog_count SET count = count + 1 '
+                        'WHERE word_id = ?', (word_id,))
+            self.con.execute('UPDATE feed_word SET count = count + ? '
+                    'WHERE feed_id = ? AND word_id = ?',
+                    (count, feed_id, word_id))
+        return True
+
+    def blog_counts(self):
+        return BlogCounts(self.con)
+
+    def word_counts(self):
+        return WordCounts(self.con)
+
+# word -> number of blogs it appeared in, read from the store on demand
+class BlogCounts:
+    def __init__(self, con):
+        self.con = con
+
+    def __len__(self):
+        return self.con.execute('SELECT COUNT(*) FROM blog_count').fetchone()[0]
+
+    def __getitem__(self, word):
+        row = self.con.execute('SELECT b.count FROM blog_count b JOIN word w '
+                'ON w.id = b.word_id WHERE w.word = ?', (word,)).fetchone()
+        if row is None:
+            raise KeyError(word)
+        return row[0]
+
+    def get(self, word, default=None):
+        try:
+            return self[word]
+        except KeyError:
+            return default
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+    def items(self):
+        return self.con.execute('SELECT w.word, b.count FROM blog_count b '
+                'JOIN word w ON w.id = b.word_id ORDER BY b.word_id')
+
+    def keys(self):
+        for word, count in self.items():
+            yield word
+
+    def __iter__(self):
+        return self.keys()
+
+    def values(self):
+        for word, count in self.items():
+            yield count
+
+# blog title -> {word: count}, one blog in memory at a time
+class WordCounts:
+    def __init__(self, con):
+        self.con = con
+
+    def __len__(self):
+        return self.con.execute('SELECT COUNT(*) FROM feed').fetchone()[0]
+
+    def get_feed_words(self, feed_id):
+        return dict(self.con.execute('SELECT w.word, f.count FROM feed_word f '
+            'JOIN word w ON w.id = f.word_id WHERE f.feed_id = ?', (feed_id,)))
+
+    def __getitem__(self, title):
+        row = self.con.execute('SELECT id FROM feed WHERE title = ?',
+                (title,)).fetchone()
+        if row is None:
+            raise KeyError(title)
+        return self.get_feed_words(row[0])
+
+    def items(self):
+        feeds = self.con.execute(
+                'SELECT id, title FROM feed ORDER BY id').fetchall()
+        for feed_id, title in feeds:
+            yield title, self.get_feed_words(feed_id)
+
+    def keys(self):
+        for row in self.con.execute('SELECT title FROM feed ORDER BY id'):
+            yield row[0]
+
+    def __iter__(self):
+        return self.keys()
+
+    def values(self):
+        for title, word_count in self.items():
+            yield word_count